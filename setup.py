@@ -20,12 +20,21 @@ setup(
         'requests==2.22.0',
         'netaddr==0.7.19',
     ],
+    extras_require = {
+        'lxml': ['lxml'],
+        'msgpack': ['msgpack'],
+    },
     scripts = [
         'bin/webrelay_info',
         'bin/webrelay_fetch',
         'bin/webrelay_diff',
         'bin/webrelay_update',
         'bin/webrelay_bootstrap',
+        'bin/webrelay_fleet',
+        'bin/webrelay_benchmark',
+        'bin/webrelay_simulator',
+        'bin/webrelay_store',
+        'bin/webrelay_poll',
     ],
     zip_safe = True
 )
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+
+'''
+asyncio driver for WebRelay devices.
+
+This module drives the same device, page and setting definitions as the
+blocking interface in webrelay.device, over a minimal HTTP/1.1 client built
+on asyncio streams. A device which is driven by this module must be created
+with an AsyncWebRelay_Session, for example by get_webrelay_device() below,
+and loaded / written with load_from_device() / write_to_device() rather than
+with its blocking methods.
+'''
+
+from __future__ import print_function
+
+from webrelay.utils import CREDENTIALS_PATH
+from webrelay.utils import VERSION_PATHS
+from webrelay.utils import Credentials
+from webrelay.utils import generate_authentication
+from webrelay.utils import check_credentials_response
+from webrelay.utils import parse_version_information
+from webrelay.utils import create_webrelay_device
+
+from webrelay.device.base import MAX_PAGE_CONCURRENCY
+from webrelay.device.state import plan_commands
+
+from webrelay.session import record_response
+from webrelay.session import masked
+from webrelay.metrics import get_registry
+
+from urllib.parse import urlencode
+
+import requests
+import asyncio
+import logging
+import base64
+import time
+
+class AsyncResponse(object):
+    '''
+    The parts of an HTTP response used by this package, with the same
+    attribute names as requests.Response.
+    '''
+    def __init__(self, url, status_code, reason, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def raise_for_status(self):
+        '''Raise requests.exceptions.HTTPError for 4xx and 5xx responses'''
+        if 400 <= self.status_code < 600:
+            msg = '{} Error: {} for url: {}'.format(self.status_code, self.reason, self.url)
+            raise requests.exceptions.HTTPError(msg, response=self)
+
+class AsyncWebRelay_Session(object):
+    '''
+    asyncio HTTP session used for all communication with WebRelay devices.
+
+    Idle connections are kept open for reuse (HTTP keep-alive) unless the
+    device closes them. The total number of requests in flight, and the
+    number of requests in flight to any single host, are both limited.
+
+    Network errors are raised as requests exceptions, so the same error
+    handling works with both the blocking and asyncio interfaces.
+
+    Like WebRelay_Session, requests with parameters are never sent twice, and
+    successful responses fetched with remember=True are handed out once by
+    fetch(), and forgotten on any request with parameters.
+    '''
+    def __init__(self, limit=100, per_host=1, timeout=10, keepalive=True):
+        self.limit = limit
+        self.per_host = per_host
+        self.timeout = timeout
+        self.keepalive = keepalive
+
+        # created on first use, inside the running event loop
+        self.semaphore = None
+        self.hostSemaphores = {}
+
+        # idle connections for each host: list of (reader, writer)
+        self.idle = {}
+
+        # remembered responses, by (hostname, path, username, password)
+        self.responses = {}
+
+    def forget(self, hostname=None):
+        '''Forget the remembered responses of one host, or of all hosts'''
+        if hostname is None:
+            self.responses.clear()
+            return
+
+        for key in [key for key in self.responses if key[0] == hostname]:
+            del self.responses[key]
+
+    async def fetch(self, hostname, path, username, password):
+        '''
+        Perform an HTTP GET request for a page without parameters, using the
+        remembered response instead of the network if there is one.
+        '''
+        response = self.responses.pop((hostname, path, username, password), None)
+        if response is not None:
+            logging.debug('Using remembered response for %s%s', hostname, path)
+            return response
+
+        return await self.get(hostname, path, username, password)
+
+    def getSemaphores(self, hostname):
+        '''Return the (global, per-host) semaphores limiting requests'''
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.limit)
+
+        if hostname not in self.hostSemaphores:
+            self.hostSemaphores[hostname] = asyncio.Semaphore(self.per_host)
+
+        return (self.semaphore, self.hostSemaphores[hostname])
+
+    async def close(self):
+        '''Close all idle connections'''
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+
+        self.idle.clear()
+
+    async def connect(self, hostname):
+        '''Open a new connection to the host'''
+        host, sep, port = hostname.partition(':')
+        port = int(port) if sep else 80
+
+        try:
+            return await asyncio.open_connection(host, port)
+        except OSError as ex:
+            raise requests.exceptions.ConnectionError(str(ex))
+
+    async def get(self, hostname, path, username, password, params=None, remember=False):
+        '''
+        Perform an HTTP GET request against a WebRelay device, returning an
+        AsyncResponse object.
+
+        With remember=True, a successful response is kept for a later fetch()
+        of the same page.
+        '''
+        # any request with parameters may change the pages of the device
+        if params is not None:
+            self.forget(hostname)
+
+        key = (hostname, path, username, password)
+
+        # like requests, leave out any parameters without a value
+        if params:
+            params = [(key, value) for key, value in params.items() if value is not None]
+
+        if params:
+            separator = '&' if '?' in path else '?'
+            path = '{}{}{}'.format(path, separator, urlencode(params))
+
+        url = 'http://{}{}'.format(hostname, path)
+        userpass = '{}:{}'.format(username, password).encode('latin-1')
+
+        lines = [
+            'GET {} HTTP/1.1'.format(path),
+            'Host: {}'.format(hostname),
+            'Authorization: Basic {}'.format(base64.b64encode(userpass).decode('ascii')),
+            'Connection: {}'.format('keep-alive' if self.keepalive else 'close'),
+            '',
+            '',
+        ]
+        request = '\r\n'.join(lines).encode('latin-1')
+
+        semaphore, hostSemaphore = self.getSemaphores(hostname)
+        async with semaphore:
+            async with hostSemaphore:
+                start = time.monotonic()
+                try:
+                    response = await asyncio.wait_for(self.request(hostname, url, request, params is None),
+                                                      self.timeout)
+                except asyncio.TimeoutError:
+                    get_registry().increment('webrelay_request_errors_total', host=hostname)
+                    raise requests.exceptions.Timeout('Request timed out for url: {}'.format(url))
+
+        metrics = get_registry()
+        if metrics.enabled:
+            record_response(metrics, hostname, path, response.status_code, len(response.content), 0,
+                            time.monotonic() - start)
+
+        if remember and response.status_code == 200:
+            self.responses[key] = response
+
+        return response
+
+    async def request(self, hostname, url, request, resend=True):
+        '''
+        Send the request, reusing an idle connection if there is one. When an
+        idle connection fails, the request is only sent again on another
+        connection with resend=True, since it may have reached the device.
+        '''
+        idle = self.idle.setdefault(hostname, [])
+        while idle:
+            reader, writer = idle.pop()
+            try:
+                return await self.exchange(hostname, url, request, reader, writer)
+            except (requests.exceptions.ConnectionError, ConnectionError) as ex:
+                if not resend:
+                    raise requests.exceptions.ConnectionError(str(ex))
+
+                # the device closed the idle connection, try the next one
+                logging.debug('Idle connection to %s was closed, reconnecting', hostname)
+
+        reader, writer = await self.connect(hostname)
+        try:
+            return await self.exchange(hostname, url, request, reader, writer)
+        except ConnectionError as ex:
+            raise requests.exceptions.ConnectionError(str(ex))
+
+    async def exchange(self, hostname, url, request, reader, writer):
+        '''Send the request on a connection and read back the response'''
+        try:
+            return await self.readResponse(hostname, url, request, reader, writer)
+        except BaseException:
+            # the connection is in an unknown state (this includes cancellation)
+            writer.close()
+            raise
+
+    async def readResponse(self, hostname, url, request, reader, writer):
+        '''Send the request on a connection and parse the response'''
+        writer.write(request)
+        await writer.drain()
+
+        # status line
+        line = await reader.readline()
+        if not line:
+            raise requests.exceptions.ConnectionError('Connection closed by {}'.format(hostname))
+
+        version, status, reason = (line.decode('latin-1').strip().split(' ', 2) + ['', ''])[:3]
+        try:
+            status_code = int(status)
+        except ValueError:
+            raise requests.exceptions.ConnectionError('Invalid HTTP status line from {}'.format(hostname))
+
+        # headers
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+            key, sep, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        # body
+        reusable = self.keepalive and version == 'HTTP/1.1'
+        if headers.get('connection', '').lower() == 'close':
+            reusable = False
+
+        try:
+            if 'chunked' in headers.get('transfer-encoding', '').lower():
+                content = await self.readChunked(reader)
+            elif 'content-length' in headers:
+                content = await reader.readexactly(int(headers['content-length']))
+            else:
+                content = await reader.read()
+                reusable = False
+        except asyncio.IncompleteReadError as ex:
+            raise requests.exceptions.ConnectionError('Incomplete response from {}: {}'.format(hostname, str(ex)))
+
+        if reusable:
+            self.idle.setdefault(hostname, []).append((reader, writer))
+        else:
+            writer.close()
+
+        return AsyncResponse(url, status_code, reason, headers, content)
+
+    async def readChunked(self, reader):
+        '''Read a body sent with chunked transfer encoding'''
+        chunks = []
+        while True:
+            line = await reader.readline()
+            size = int(line.split(b';', 1)[0].strip() or b'0', 16)
+            if size == 0:
+                # skip any trailers
+                while line not in (b'\r\n', b'\n', b''):
+                    line = await reader.readline()
+
+                return b''.join(chunks)
+
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+
+async def cancel_tasks(tasks):
+    '''Cancel any unfinished tasks, and wait for them to finish'''
+    for task in tasks:
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def test_credentials(creds, session):
+    '''
+    Test if the given credentials is valid for configuring a WebRelay device.
+    '''
+    logging.debug('Testing Credentials: USER=%s PASS=%s', creds.username, masked(creds.password))
+
+    try:
+        response = await session.get(creds.hostname, CREDENTIALS_PATH, creds.username, creds.password,
+                                       remember=True)
+        return check_credentials_response(response)
+    except requests.exceptions.ConnectionError as ex:
+        raise
+    except requests.exceptions.Timeout as ex:
+        raise
+    except Exception as ex:
+        logging.warning('Unexpected Exception: %s', ex)
+        return False
+
+async def detect_credentials(hostname, session, username=None, password=None, password_file=None, concurrency=1):
+    '''
+    Generate a credentials list, and try them until a working set is found.
+
+    With a concurrency greater than one, up to that many credentials are
+    tested at the same time (subject to the per-host limit of the session).
+    The first working credentials in the list always win, and all other
+    tests are cancelled as soon as the winner is known.
+
+    Network errors are raised to the caller as requests exceptions.
+    '''
+    credentials = generate_authentication(username, password, password_file)
+    candidates = [Credentials(hostname, username, password) for username, password in credentials]
+
+    concurrency = max(1, min(concurrency, MAX_PAGE_CONCURRENCY))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited_test_credentials(creds):
+        async with semaphore:
+            return await test_credentials(creds, session)
+
+    tasks = [asyncio.ensure_future(limited_test_credentials(creds)) for creds in candidates]
+    try:
+        for creds, task in zip(candidates, tasks):
+            success = await task
+            if success:
+                logging.debug('Detected working credentials: USER=%s PASS=%s', creds.username,
+                              masked(creds.password))
+                return creds
+
+        return None
+    finally:
+        await cancel_tasks(tasks)
+
+async def fetch_version_information(creds, session):
+    '''
+    Fetch the WebRelay version information into a VersionInfo structure.
+    '''
+    for path in VERSION_PATHS:
+        response = await session.get(creds.hostname, path, creds.username, creds.password)
+
+        info = parse_version_information(response.status_code, response.content)
+        if info is not None:
+            return info
+
+    # None of the possible information pages was accessible
+    raise RuntimeError('Unable to fetch version information')
+
+async def get_webrelay_device(creds, session):
+    '''
+    Get the specialized device class for this WebRelay, using the asyncio
+    session for all communication.
+    '''
+    info = await fetch_version_information(creds, session)
+    return create_webrelay_device(creds, info, session)
+
+async def fetch_path(device, path):
+    '''
+    Fetch the raw HTML content at one path from the device, reusing the
+    response from credential detection if the session remembered it.
+    '''
+    logging.debug('Fetch PATH=%s with USER=%s PASS=%s', path, device.username, masked(device.password))
+
+    response = await device.session.fetch(device.hostname, path, device.username, device.password)
+    response.raise_for_status()
+
+    return (path, response.content)
+
+async def load_from_device(device, concurrency=1, pages=None):
+    '''
+    Load the settings from the device into the device object: all pages by
+    default, or only the pages with the given names.
+
+    With a concurrency greater than one, up to that many pages (but never
+    more than MAX_PAGE_CONCURRENCY) are requested at the same time, and each
+    page is parsed as soon as it arrives. The per-host limit of the session
+    still applies. Pages which share a path are fetched and parsed only once.
+
+    Responses remembered by the session during detection are forgotten after
+    this load.
+    '''
+    try:
+        await load_pages(device, concurrency, pages)
+    finally:
+        device.session.forget(device.hostname)
+
+async def load_pages(device, concurrency=1, pages=None):
+    '''Load the settings of all pages, or of the pages with the given names (see load_from_device())'''
+    if pages is not None:
+        paths = device.getPagesByPath(device.findPages(pages))
+    else:
+        paths = device.getPagesByPath()
+
+    concurrency = max(1, min(concurrency, MAX_PAGE_CONCURRENCY))
+    if concurrency == 1:
+        for path, pages in paths.items():
+            path, content = await fetch_path(device, path)
+            device.parsePages(pages, content)
+
+        return
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited_fetch_path(path):
+        async with semaphore:
+            return await fetch_path(device, path)
+
+    tasks = [asyncio.ensure_future(limited_fetch_path(path)) for path in paths]
+    try:
+        for future in asyncio.as_completed(tasks):
+            path, content = await future
+            device.parsePages(paths[path], content)
+    finally:
+        await cancel_tasks(tasks)
+
+async def read_state(device):
+    '''Read the live state of all relays and inputs in one request, returning a RelayState'''
+    path = device.getStatePath()
+    logging.debug('Read state PATH=%s with USER=%s PASS=%s', path, device.username, masked(device.password))
+
+    response = await device.session.get(device.hostname, path, device.username, device.password)
+    response.raise_for_status()
+
+    return device.parseState(response.content)
+
+async def send_commands(device, commands):
+    '''
+    Carry out a list of RelayCommand, in order, in as few requests as the
+    model permits. Return the RelayState from the response to the last request.
+    '''
+    batches = plan_commands(device.stateLayout, commands)
+    if not batches:
+        raise RuntimeError('You called send_commands() without any commands')
+
+    path = device.getStatePath()
+    for params in batches:
+        response = await device.session.get(device.hostname, path, device.username, device.password, params=params)
+        response.raise_for_status()
+
+    return device.parseState(response.content)
+
+async def write_plan(device, plan):
+    '''Make every HTTP request of an UpdatePlan, in order'''
+    device.checkPlan(plan)
+
+    for write in plan.writes:
+        if write.method != 'GET':
+            raise RuntimeError('HTTP methods other than GET are not yet supported')
+
+        response = await device.session.get(device.hostname, write.path, device.username, device.password,
+                                            params=write.params)
+        response.raise_for_status()
+
+        device.writeWasCompleted(write)
+
+async def verify_plan(device, plan, concurrency=1):
+    '''
+    Verify that an UpdatePlan was written to the device, fetching only the
+    pages which were written. Return a list of VerifyMismatch.
+    '''
+    await load_from_device(device, concurrency, [write.page for write in plan.writes])
+    return device.comparePlan(plan)
+
+async def write_to_device(device):
+    '''Write all updated settings from the device object onto the device'''
+    plan = device.planUpdate()
+    if not plan.needsUpdate():
+        raise RuntimeError('You called write_to_device() on a device without updates')
+
+    await write_plan(device, plan)
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
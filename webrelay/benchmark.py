@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks for the WebRelay package.
+'''
+
+from __future__ import print_function
+
+from webrelay.device.parser import available_parsers
+from webrelay.device.parser import get_parser
+
+from webrelay.device.settings import Setting_Text
+
+from webrelay.simulator import SIMULATOR_MODELS
+from webrelay.simulator import Simulated_WebRelay
+from webrelay.simulator import simulated_serial_number
+from webrelay.simulator import start_simulators
+from webrelay.simulator import stop_simulators
+
+from webrelay.io import FORMATS
+from webrelay.io import read_snapshot
+from webrelay.io import snapshot_document
+from webrelay.io import write_snapshot
+
+import webrelay.io
+
+from webrelay.utils import find_credentials
+from webrelay.utils import get_webrelay_device
+
+from webrelay.session import WebRelay_Session
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from collections import namedtuple
+
+import tempfile
+import time
+import os
+
+# Elements whose text holds the version information
+TEXT_TAGS = ('p', 'tr')
+
+# Attributes whose value is irrelevant, only their presence
+BOOLEAN_ATTRIBUTES = frozenset(['checked', 'selected', 'disabled', 'readonly', 'multiple'])
+
+# Structure to hold the result of one parser benchmark
+ParserResult = namedtuple('ParserResult', [
+    'parser',
+    'document',
+    'size',
+    'seconds',
+    'matches',
+])
+
+# Structure to hold the result of one snapshot format benchmark
+SnapshotResult = namedtuple('SnapshotResult', [
+    'format',
+    'documents',
+    'size',
+    'writeSeconds',
+    'readSeconds',
+    'matches',
+])
+
+# Phases of the device benchmark, in the order they run
+DEVICE_PHASES = ('detect', 'load', 'diff', 'write')
+
+# Structure to hold the result of one phase of the device benchmark
+DeviceResult = namedtuple('DeviceResult', [
+    'phase',
+    'devices',
+    'seconds',
+    'requests',
+])
+
+def normalize_attrs(attrs):
+    '''Normalize an attribute dictionary so that all backends compare equal'''
+    return {key: True if key in BOOLEAN_ATTRIBUTES else value for key, value in attrs.items()}
+
+def normalize_form(form):
+    '''Normalize a FormIndex into plain data, so that all backends compare equal'''
+    inputs = {}
+    for key, elements in form.inputsByName.items():
+        inputs[key] = [normalize_attrs(attrs) for attrs in elements]
+
+    selects = {}
+    for key, elements in form.selectsByName.items():
+        selects[key] = [[(normalize_attrs(option.attrs), option.text) for option in options] for options in elements]
+
+    return (inputs, selects)
+
+def parse_document(parser, content):
+    '''Extract everything this package uses from one document'''
+    return (normalize_form(parser.parseForm(content)), parser.parseText(content, TEXT_TAGS))
+
+def benchmark_parsers(documents, names=None, repeat=50):
+    '''
+    Time each parser backend on each (name, content) document, and check
+    that each one extracts the same data as BeautifulSoup with html.parser.
+    Yield a ParserResult for each parser and document.
+    '''
+    if names is None:
+        names = available_parsers()
+
+    reference = get_parser('html.parser')
+    for document, content in documents:
+        expected = parse_document(reference, content)
+
+        for name in names:
+            parser = get_parser(name)
+            matches = parse_document(parser, content) == expected
+
+            start = time.perf_counter()
+            for i in range(repeat):
+                parser.parseForm(content)
+
+            seconds = (time.perf_counter() - start) / repeat
+            yield ParserResult(name, document, len(content), seconds, matches)
+
+def simulator_documents(models=None):
+    '''Render all of the configuration pages of the simulated models, as (name, content) documents'''
+    if models is None:
+        models = list(SIMULATOR_MODELS)
+
+    documents = []
+    for model in models:
+        device = Simulated_WebRelay(model, simulated_serial_number(1))
+        for path in device.pages:
+            documents.append(('{}{}'.format(model, path), device.renderPage(path)))
+
+    return documents
+
+def simulator_configuration(model, serialNumber):
+    '''Build the configuration of a simulated device, parsed from its rendered pages without any network requests'''
+    simulator = Simulated_WebRelay(model, serialNumber)
+    device = simulator.model.deviceClass('simulator', simulator.username, simulator.password)
+    for path, pages in device.getPagesByPath().items():
+        device.parsePages(pages, simulator.renderPage(path))
+
+    return snapshot_document('webrelay{}'.format(serialNumber.replace(':', '').lower()),
+                             simulator.model.modelNumber, serialNumber, device.toDict())
+
+def benchmark_snapshots(count=1000, models=None, formats=None):
+    '''
+    Time writing and reading a snapshot of count simulated devices (cycling
+    through the list of models) in each format, and check that each format
+    reads back exactly the same documents. Yield a SnapshotResult for each
+    format.
+    '''
+    if models is None:
+        models = list(SIMULATOR_MODELS)
+
+    if formats is None:
+        formats = [format for format in FORMATS if format != 'msgpack' or webrelay.io.msgpack is not None]
+
+    documents = [simulator_configuration(models[index % len(models)], simulated_serial_number(index + 1))
+                 for index in range(count)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        for format in formats:
+            filename = os.path.join(directory, 'snapshot.{}'.format(format))
+
+            start = time.perf_counter()
+            write_snapshot(documents, filename, format)
+            writeSeconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            result = list(read_snapshot(filename))
+            readSeconds = time.perf_counter() - start
+
+            size = os.path.getsize(filename)
+            yield SnapshotResult(format, count, size, writeSeconds, readSeconds, result == documents)
+
+def modify_configuration(device):
+    '''Build a configuration which changes the first text setting on each page of a loaded device'''
+    data = OrderedDict()
+    for page in device.pages:
+        for setting in page.settings:
+            if type(setting) is not Setting_Text:
+                continue
+
+            value = 'benchmark' if setting.deviceValue != 'benchmark' else 'webrelay'
+            data.setdefault(page.name, OrderedDict())[setting.name] = value
+            break
+
+    return data
+
+def count_requests(simulators):
+    '''Total number of requests served by all of the simulators'''
+    return sum(simulator.getStats()['requests'] for simulator in simulators)
+
+def benchmark_devices(models=None, counts=(1, ), username='admin', password='webrelay', latency=0.0, jitter=0.0,
+                      max_connections=None, max_workers=None, concurrency=1):
+    '''
+    Benchmark the full pipeline against simulated devices, for each number
+    of devices in counts. The devices cycle through the list of models. All
+    devices are handled concurrently, by up to max_workers threads (default:
+    one per device).
+
+    Each phase is timed on its own, for all of the devices together:
+    - detect: find the working credentials and the device model
+    - load: fetch and parse all configuration pages
+    - diff: apply a changed configuration and build the differences
+    - write: write the changed settings back to the device
+
+    Yield a DeviceResult for each number of devices and phase.
+    '''
+    if models is None:
+        models = list(SIMULATOR_MODELS)
+
+    for count in counts:
+        simulators = start_simulators(models, count, username=username, password=password, latency=latency,
+                                      jitter=jitter, max_connections=max_connections)
+
+        session = WebRelay_Session(pool_hosts=count)
+        workers = max_workers or count
+
+        def detect(simulator):
+            creds = find_credentials(simulator.hostname, username, password, session=session)
+            if creds is None:
+                raise RuntimeError('Unable to authenticate to simulator {}'.format(simulator.hostname))
+
+            return get_webrelay_device(creds, session)
+
+        def load(device):
+            device.loadFromDevice(concurrency)
+            return device
+
+        def diff(device):
+            device.fromDict(modify_configuration(device))
+            device.toDiffDict()
+            return device
+
+        def write(device):
+            device.writeToDevice()
+            return device
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                items = simulators
+                for phase, func in zip(DEVICE_PHASES, (detect, load, diff, write)):
+                    requests = count_requests(simulators)
+                    start = time.perf_counter()
+                    items = list(executor.map(func, items))
+                    seconds = time.perf_counter() - start
+
+                    yield DeviceResult(phase, count, seconds, count_requests(simulators) - requests)
+        finally:
+            session.close()
+            stop_simulators(simulators)
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+from webrelay.utils import Credentials
+from webrelay.utils import VersionInfo
+
+from collections import OrderedDict
+
+import threading
+import hashlib
+import logging
+import json
+import time
+import os
+
+def hash_password(salt, hostname, username, password):
+    '''Hash a password, so that it can be recognized without being stored'''
+    data = '\0'.join([salt, hostname, username, password])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+class DeviceCache(object):
+    '''
+    On-disk cache of the working credentials and version information of
+    each WebRelay host, so that repeated runs can skip credential detection
+    and model detection.
+
+    The password itself is never stored, only a salted hash of it. On the
+    next run, the hash is matched against the list of credentials to try.
+
+    Entries expire after the TTL (in seconds). Callers should invalidate an
+    entry when the device rejects the cached credentials, or when its pages
+    do not match the cached model.
+    '''
+    def __init__(self, filename, ttl=86400):
+        self.filename = filename
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = self.read()
+
+    def read(self):
+        '''Read all entries from the cache file'''
+        try:
+            with open(self.filename, 'r') as f:
+                return json.load(f, object_pairs_hook=OrderedDict)
+        except FileNotFoundError:
+            return OrderedDict()
+        except ValueError as ex:
+            logging.warning('Ignoring corrupt cache file %s: %s', self.filename, ex)
+            return OrderedDict()
+
+    def save(self):
+        '''Write all entries to the cache file'''
+        with self.lock:
+            data = json.dumps(self.entries, indent=4)
+
+        # replace the file atomically, readable only by the owner
+        tmpname = '{}.tmp'.format(self.filename)
+        fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+
+        os.replace(tmpname, self.filename)
+
+    def lookup(self, hostname, credentials):
+        '''
+        Find the cached (Credentials, VersionInfo) for a host, given the
+        list of (username, password) credentials to try. Return None if
+        there is no fresh entry matching one of the credentials.
+        '''
+        with self.lock:
+            entry = self.entries.get(hostname)
+
+        if entry is None:
+            return None
+
+        if time.time() - entry['timestamp'] > self.ttl:
+            logging.debug('Cache entry for %s has expired', hostname)
+            self.invalidate(hostname)
+            return None
+
+        for username, password in credentials:
+            if username != entry['username']:
+                continue
+
+            if hash_password(entry['salt'], hostname, username, password) != entry['passwordHash']:
+                continue
+
+            creds = Credentials(hostname, username, password)
+            info = VersionInfo(entry['modelNumber'], entry['firmwareVersion'], entry['serialNumber'])
+            return (creds, info)
+
+        return None
+
+    def update(self, creds, info):
+        '''Record the working credentials and version information of a host'''
+        salt = os.urandom(16).hex()
+
+        entry = OrderedDict()
+        entry['username'] = creds.username
+        entry['salt'] = salt
+        entry['passwordHash'] = hash_password(salt, creds.hostname, creds.username, creds.password)
+        entry['modelNumber'] = info.modelNumber
+        entry['firmwareVersion'] = info.firmwareVersion
+        entry['serialNumber'] = info.serialNumber
+        entry['timestamp'] = time.time()
+
+        with self.lock:
+            self.entries[creds.hostname] = entry
+
+    def invalidate(self, hostname):
+        '''Forget everything about a host'''
+        with self.lock:
+            self.entries.pop(hostname, None)
+
+class ParseCache(object):
+    '''
+    Bounded (least recently used) cache of the parsed settings of each page
+    of each WebRelay host, keyed by the fingerprint of the raw page content.
+
+    Parsing the HTML forms is the main CPU cost of loading a device, but
+    most pages are byte-identical from one run to the next. When the content
+    of a page matches the cached fingerprint, the settings are restored from
+    the cached state (see WebRelay_Page.saveState()) instead.
+
+    The cache can be saved to a file, readable only by the owner, to be
+    shared by repeated fleet runs. Passwords are saved as they appear in the
+    HTML form (a placeholder), never the real password.
+    '''
+    def __init__(self, filename=None, max_entries=4096):
+        self.filename = filename
+        self.maxEntries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # "hostname path" -> entry, least recently used first
+        self.entries = OrderedDict()
+        if filename is not None:
+            self.entries = self.read()
+            self.trim()
+
+    def read(self):
+        '''Read all entries from the cache file'''
+        try:
+            with open(self.filename, 'r') as f:
+                return json.load(f, object_pairs_hook=OrderedDict)
+        except FileNotFoundError:
+            return OrderedDict()
+        except ValueError as ex:
+            logging.warning('Ignoring corrupt cache file %s: %s', self.filename, ex)
+            return OrderedDict()
+
+    def save(self):
+        '''Write all entries to the cache file'''
+        if self.filename is None:
+            return
+
+        with self.lock:
+            data = json.dumps(self.entries, separators=(',', ':'))
+
+        # replace the file atomically, readable only by the owner
+        tmpname = '{}.tmp'.format(self.filename)
+        fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+
+        os.replace(tmpname, self.filename)
+
+    def trim(self):
+        '''Drop the least recently used entries beyond the maximum number of entries'''
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def lookup(self, hostname, path, fingerprint):
+        '''
+        Return the saved state of the pages at a path of a host, a dictionary
+        of page name -> page state, if the content still has the given
+        fingerprint. Otherwise, return None.
+        '''
+        key = '{} {}'.format(hostname, path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry['fingerprint'] != fingerprint:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry['pages']
+
+    def update(self, hostname, path, fingerprint, pages):
+        '''Record the state of the pages parsed from content with the given fingerprint'''
+        entry = OrderedDict()
+        entry['fingerprint'] = fingerprint
+        entry['pages'] = pages
+
+        key = '{} {}'.format(hostname, path)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            self.trim()
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
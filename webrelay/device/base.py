@@ -3,9 +3,36 @@
 from __future__ import print_function
 from collections import OrderedDict
 
-import requests
+from webrelay.session import WebRelay_Session
+from webrelay.session import masked
+from webrelay.metrics import get_registry
+from webrelay.metrics import timed
+from webrelay.plan import PlannedWrite
+from webrelay.plan import UpdatePlan
+from webrelay.plan import VerifyMismatch
+
+from webrelay.device.form import FormIndex
+from webrelay.device.parser import get_parser
+from webrelay.device.state import STATE_PATH
+from webrelay.device.state import StateLayout
+from webrelay.device.state import RelayCommand
+from webrelay.device.state import parse_state
+from webrelay.device.state import plan_commands
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+
+import hashlib
 import logging
-import bs4
+import time
+
+# The embedded web server falls over when it has too many open sockets, so
+# never fetch more than this many pages from one device at the same time
+MAX_PAGE_CONCURRENCY = 4
+
+def fingerprint_content(content):
+    '''Return the fingerprint of the raw content of a page'''
+    return hashlib.sha256(content).hexdigest()
 
 class WebRelay_Page(object):
     '''
@@ -13,8 +40,47 @@ class WebRelay_Page(object):
     '''
     def __init__(self, name):
         self.name = name
+
+        # Device holding this page (notified whenever needsUpdate() changes),
+        # and the position of this page on the device
+        self.owner = None
+        self.index = 0
+
+        # positions of the settings which need an update, see settingChanged()
+        self.changed = set()
         self.settings = []
 
+        # have the current settings been loaded from the device?
+        self.loaded = False
+
+    @property
+    def settings(self):
+        return self._settings
+
+    @settings.setter
+    def settings(self, settings):
+        '''Attach the settings to this page, so that they report any changes'''
+        self._settings = list(settings)
+        self.changed = set()
+        for index, elem in enumerate(self._settings):
+            elem.owner = self
+            elem.index = index
+            if elem.needsUpdate():
+                self.changed.add(index)
+
+        if self.owner is not None:
+            self.owner.pageChanged(self)
+
+    def settingChanged(self, elem):
+        '''Hook called by a setting whenever its needsUpdate() changes'''
+        if elem.needsUpdate():
+            self.changed.add(elem.index)
+        else:
+            self.changed.discard(elem.index)
+
+        if self.owner is not None:
+            self.owner.pageChanged(self)
+
     def getPath(self):
         '''Return the HTTP Path to the form to fetch the current settings'''
         raise RuntimeError('You forgot to implement the getPath() method')
@@ -33,33 +99,58 @@ class WebRelay_Page(object):
         '''
         return 'GET'
 
-    def getUpdateParams(self):
-        '''Return a dictionary of query parameters needing update'''
-        if not self.needsUpdate():
+    def getUpdateParams(self, settings=None):
+        '''
+        Return a dictionary of query parameters needing update. The changed
+        settings are found, unless they are given (see getChangedSettings()).
+        '''
+        if settings is None:
+            settings = self.getChangedSettings()
+
+        if not settings:
             raise RuntimeError('No update was needed. No settings were changed.')
 
         params = {}
-        for elem in self.settings:
-            if elem.needsUpdate():
-                params.update(elem.getUpdateParams())
+        for elem in settings:
+            params.update(elem.getUpdateParams())
 
         return params
 
+    def getChangedSettings(self):
+        '''Return the settings which have been changed by the user, in order'''
+        return [self._settings[index] for index in sorted(self.changed)]
+
     def needsUpdate(self):
         '''
         Does this configuration page need to update the device? Have any
         settings been changed by the user?
         '''
-        for elem in self.settings:
-            if elem.needsUpdate():
-                return True
-
-        return False
+        return len(self.changed) > 0
 
     def fromSoup(self, soup):
         '''Load all of the current settings from the device from BeautifulSoup'''
+        self.fromForm(FormIndex.fromSoup(soup))
+
+    def fromForm(self, form):
+        '''Load all of the current settings from the device from a FormIndex'''
         for elem in self.settings:
-            elem.fromSoup(soup)
+            elem.fromForm(form)
+
+        self.loaded = True
+
+    def saveState(self):
+        '''Return the state loaded by fromForm() of every setting, in order'''
+        return [elem.saveState() for elem in self.settings]
+
+    def restoreState(self, state):
+        '''Restore the state saved by saveState(), exactly as if fromForm() had run again'''
+        if len(state) != len(self.settings):
+            raise RuntimeError('Saved state of page {} does not match its settings'.format(self.name))
+
+        for elem, elemState in zip(self.settings, state):
+            elem.restoreState(elemState)
+
+        self.loaded = True
 
     def toDict(self):
         '''Build a nested dictionary representing this page'''
@@ -75,11 +166,22 @@ class WebRelay_Page(object):
             if elem.name in data:
                 elem.fromDict(data[elem.name])
 
+    def toDiffDict(self):
+        '''Build a nested dictionary of changed settings on this page'''
+        data = OrderedDict()
+        for elem in self.getChangedSettings():
+            data.update(elem.toDiffDict())
+
+        if not data:
+            return OrderedDict()
+
+        return OrderedDict({self.name: data, })
+
     def printDiff(self):
         '''Print a YAML-like unified diff of changed settings'''
         if self.needsUpdate():
             print('{}:'.format(self.name))
-            for elem in self.settings:
+            for elem in self.getChangedSettings():
                 elem.printDiff()
 
     def passwordWasChanged(self):
@@ -101,81 +203,437 @@ class WebRelay_Base(object):
     A WebRelay device consists of:
     - hostname / username / password
     - a set of configuration pages (HTML forms)
+    - an HTTP session (shared connection pool)
+    - the version information, if known
+    - the layout of the state document, which reads and controls its relays
     '''
-    def __init__(self, hostname, username, password):
+    # layout of the state document, see readState() and sendCommands()
+    stateLayout = StateLayout((), (), (), 1)
+
+    def __init__(self, hostname, username, password, session=None):
         self.hostname = hostname
         self.username = username
         self.password = password
+        self.versionInfo = None
+
+        # positions of the pages which need an update, see pageChanged()
+        self.changed = set()
         self.pages = []
 
-    def loadFromDevice(self):
-        '''Load all of the settings from the device into this object'''
+        # load any other pages on demand, see loadFromDevice()
+        self.lazy = False
+        self.lazyConcurrency = 1
+
+        # skip parsing pages which did not change since the last run, see parsePages()
+        self.parseCache = None
+
+        if session is None:
+            session = WebRelay_Session()
+
+        self.session = session
+
+    @property
+    def pages(self):
+        return self._pages
+
+    @pages.setter
+    def pages(self, pages):
+        '''Attach the pages to this device, so that they report any changes'''
+        self._pages = list(pages)
+        self.changed = set()
+        for index, page in enumerate(self._pages):
+            page.owner = self
+            page.index = index
+            if page.needsUpdate():
+                self.changed.add(index)
+
+    def pageChanged(self, page):
+        '''Hook called by a page whenever one of its settings changes needsUpdate()'''
+        if page.needsUpdate():
+            self.changed.add(page.index)
+        else:
+            self.changed.discard(page.index)
+
+    def getChangedPages(self):
+        '''Return the pages with settings changed by the user, in order'''
+        return [self._pages[index] for index in sorted(self.changed)]
+
+    def findPages(self, names):
+        '''Return the pages with any of the given names, in order, ignoring unknown names'''
+        names = set(names)
+        return [page for page in self.pages if page.name in names]
+
+    def getPagesByPath(self, pages=None):
+        '''
+        Group the pages by HTTP path, in order. Some models show the settings
+        of several pages in one form, which only needs to be fetched once.
+
+        Given a list of pages, only the paths of those pages are included,
+        along with every page sharing one of those paths.
+        '''
+        paths = OrderedDict()
         for page in self.pages:
-            url = 'http://{}{}'.format(self.hostname, page.getPath())
-            auth = requests.auth.HTTPBasicAuth(self.username, self.password)
+            paths.setdefault(page.getPath(), []).append(page)
+
+        if pages is None:
+            return paths
 
-            logging.debug('Fetch URL={} with USER={} PASS={}'.format(url, self.username, self.password))
+        wanted = set(page.getPath() for page in pages)
+        return OrderedDict((path, group) for path, group in paths.items() if path in wanted)
+
+    def parsePage(self, page, content):
+        '''Load the settings of one page from the raw HTML content of the page'''
+        self.parsePages([page, ], content)
+
+    def parsePages(self, pages, content):
+        '''
+        Load the settings of several pages from the raw HTML content of their
+        shared form.
 
-            response = requests.get(url, auth=auth, timeout=10)
+        With a ParseCache, content identical to the last content seen at the
+        same path of this host is not parsed again: the settings are restored
+        from the state saved by the cache instead.
+        '''
+        cache = self.parseCache
+        if cache is None:
+            self.parseForm(pages, content)
+            return
+
+        path = pages[0].getPath()
+        fingerprint = fingerprint_content(content)
+        metrics = get_registry()
+
+        states = cache.lookup(self.hostname, path, fingerprint)
+        if states is not None:
+            try:
+                for page in pages:
+                    page.restoreState(states[page.name])
+
+                logging.debug('Content of PATH=%s is unchanged, restored settings from cache', path)
+                metrics.increment('webrelay_parse_cache_total', result='hit')
+                return
+            except (KeyError, TypeError, RuntimeError) as ex:
+                logging.debug('Ignoring cached state of PATH=%s: %s', path, ex)
+
+        metrics.increment('webrelay_parse_cache_total', result='miss')
+        self.parseForm(pages, content)
+        cache.update(self.hostname, path, fingerprint, OrderedDict((page.name, page.saveState()) for page in pages))
+
+    def parseForm(self, pages, content):
+        '''Parse the raw HTML content of a form, and load the settings of several pages from it'''
+        start = time.monotonic()
+        form = get_parser().parseForm(content)
+        parsed = time.monotonic()
+
+        for page in pages:
+            page.fromForm(form)
+
+        # time spent parsing the HTML, and loading the settings from the parsed form
+        metrics = get_registry()
+        if metrics.enabled:
+            metrics.observe('webrelay_phase_seconds', parsed - start, phase='parse')
+            metrics.observe('webrelay_phase_seconds', time.monotonic() - parsed, phase='settings')
+            metrics.observe('webrelay_parse_seconds', parsed - start, path=pages[0].getPath())
+
+    def getWriteRequest(self, page, settings=None):
+        '''Return the PlannedWrite (HTTP request) which writes the changed settings of this page'''
+        if settings is None:
+            settings = page.getChangedSettings()
+
+        # TODO FIXME: support something other than GET
+        method = page.getUpdateMethod()
+        if method != 'GET':
+            raise RuntimeError('HTTP methods other than GET are not yet supported')
+
+        path = page.getUpdatePath()
+        params = page.getUpdateParams(settings)
+
+        changes = OrderedDict()
+        for elem in settings:
+            changes.update(elem.toDiffDict())
+
+        newPassword = None
+        if page.passwordWasChanged():
+            newPassword = page.getNewPassword()
+
+        return PlannedWrite(page.name, method, path, params, changes, newPassword)
+
+    def planUpdate(self):
+        '''
+        Build the UpdatePlan which writes all updated settings from this
+        object onto the device: one request per page with changed settings,
+        with the pages which change the password last.
+        '''
+        writes = []
+        passwordWrites = []
+        for page in self.getChangedPages():
+            write = self.getWriteRequest(page, page.getChangedSettings())
+            if write.newPassword is not None:
+                passwordWrites.append(write)
+            else:
+                writes.append(write)
+
+        info = self.versionInfo
+        modelNumber = info.modelNumber if info is not None else None
+        serialNumber = info.serialNumber if info is not None else None
+
+        return UpdatePlan(self.hostname, modelNumber, serialNumber, writes + passwordWrites)
+
+    def checkPlan(self, plan):
+        '''Make sure an UpdatePlan was made for this device'''
+        info = self.versionInfo
+        if info is None:
+            return
+
+        if plan.modelNumber != info.modelNumber or plan.serialNumber != info.serialNumber:
+            raise RuntimeError('Update plan for {} ({}) does not match device {} ({})'.format(
+                plan.serialNumber, plan.modelNumber, info.serialNumber, info.modelNumber))
+
+    def writeWasCompleted(self, write):
+        '''Hook called after each PlannedWrite has been written to the device'''
+        # start using the new password for all future requests
+        if write.newPassword is not None:
+            logging.debug('Password was changed, updating password used to access device')
+            self.password = write.newPassword
+
+    def maskParams(self, write):
+        '''Return the query parameters of a PlannedWrite, with the values of password settings masked'''
+        secrets = set()
+        for page in self.findPages([write.page, ]):
+            for elem in page.settings:
+                if elem.isSecret():
+                    secrets.add(elem.formName)
+
+        return {key: masked(value) if key in secrets else value for key, value in write.params.items()}
+
+    @timed('write')
+    def writePlan(self, plan):
+        '''Make every HTTP request of an UpdatePlan, in order'''
+        self.checkPlan(plan)
+
+        for write in plan.writes:
+            if write.method != 'GET':
+                raise RuntimeError('HTTP methods other than GET are not yet supported')
+
+            logging.debug('Write PATH=%s with USER=%s PASS=%s', write.path, self.username, masked(self.password))
+            logging.debug('Parameters: %s', self.maskParams(write))
+
+            response = self.session.get(self.hostname, write.path, self.username, self.password,
+                                        params=write.params)
             response.raise_for_status()
 
-            soup = bs4.BeautifulSoup(response.content, 'html.parser')
-            page.fromSoup(soup)
+            self.writeWasCompleted(write)
 
-    def writeToDevice(self):
-        '''Write all updated settings from this object onto the device'''
-        if not self.needsUpdate():
-            raise RuntimeError('You called writeToDevice() on a device without updates')
+    def getStatePath(self):
+        '''Return the HTTP Path to the state document (live state of the relays and inputs)'''
+        return STATE_PATH
 
-        for page in self.pages:
-            if page.needsUpdate():
-                # TODO FIXME: support something other than GET
-                method = page.getUpdateMethod()
-                if method != 'GET':
-                    raise RuntimeError('HTTP methods other than GET are not yet supported')
+    @timed('state')
+    def readState(self):
+        '''
+        Read the live state of all relays and inputs in one request, returning
+        a RelayState. Unlike the configuration pages, the state is never
+        remembered by the session: every call reads it again.
+        '''
+        path = self.getStatePath()
+        logging.debug('Read state PATH=%s with USER=%s PASS=%s', path, self.username, masked(self.password))
+
+        response = self.session.get(self.hostname, path, self.username, self.password)
+        response.raise_for_status()
+
+        return self.parseState(response.content)
+
+    def parseState(self, content):
+        '''Parse the raw content of the state document into a RelayState'''
+        return parse_state(self.stateLayout, content, self.hostname)
+
+    @timed('control')
+    def sendCommands(self, commands):
+        '''
+        Carry out a list of RelayCommand, in order, batching the commands for
+        several relays into as few requests as the model permits (see
+        plan_commands()). Return the RelayState from the response to the last
+        request, which already holds the result of every command.
+        '''
+        batches = plan_commands(self.stateLayout, commands)
+        if not batches:
+            raise RuntimeError('You called sendCommands() without any commands')
+
+        path = self.getStatePath()
+        for params in batches:
+            logging.debug('Control PATH=%s with USER=%s PASS=%s', path, self.username, masked(self.password))
+            logging.debug('Commands: %s', params)
+
+            response = self.session.get(self.hostname, path, self.username, self.password, params=params)
+            response.raise_for_status()
+
+        return self.parseState(response.content)
+
+    def setRelay(self, relay, on):
+        '''Turn one relay (numbered from 1) on or off, returning the resulting RelayState'''
+        return self.sendCommands([RelayCommand(relay, 'on' if on else 'off'), ])
 
-                url = 'http://{}{}'.format(self.hostname, page.getUpdatePath())
-                auth = requests.auth.HTTPBasicAuth(self.username, self.password)
-                params = page.getUpdateParams()
+    def pulseRelay(self, relay):
+        '''Pulse one relay (numbered from 1) for its configured pulse duration, returning the resulting RelayState'''
+        return self.sendCommands([RelayCommand(relay, 'pulse'), ])
 
-                logging.debug('Write URL={} with USER={} PASS={}'.format(url, self.username, self.password))
-                logging.debug('Parameters: {}'.format(params))
+    def fetchPage(self, page):
+        '''Fetch the raw HTML content of one page from the device'''
+        return self.fetchPath(page.getPath())
+
+    def fetchPath(self, path):
+        '''
+        Fetch the raw HTML content at one path from the device, reusing the
+        response from credential detection if the session remembered it.
+        '''
+        logging.debug('Fetch PATH=%s with USER=%s PASS=%s', path, self.username, masked(self.password))
+
+        response = self.session.fetch(self.hostname, path, self.username, self.password)
+        response.raise_for_status()
+
+        return response.content
+
+    def loadFromDevice(self, concurrency=1, pages=None, lazy=False):
+        '''
+        Load the settings from the device into this object.
+
+        By default, all pages are loaded. Given a list of page names, only
+        those pages are loaded. With lazy=True, nothing else is loaded up
+        front (not even all pages, if no names are given): each page is
+        loaded the first time fromDict() or toDict() needs it instead.
+
+        Responses remembered by the session during detection are only used
+        by this first load, and are forgotten afterwards.
+        '''
+        self.lazy = lazy
+        self.lazyConcurrency = concurrency
+
+        try:
+            if pages is not None:
+                self.loadPages(self.findPages(pages), concurrency)
+            elif not lazy:
+                self.loadPages(self.pages, concurrency)
+        finally:
+            self.session.forget(self.hostname)
+
+    def loadMissingPages(self, pages):
+        '''In lazy mode, load any of the given pages which have not been loaded yet'''
+        if not self.lazy:
+            return
+
+        missing = [page for page in pages if not page.loaded]
+        if missing:
+            self.loadPages(missing, self.lazyConcurrency)
+
+    @timed('load')
+    def loadPages(self, pages, concurrency=1):
+        '''
+        Load the settings of the given pages from the device.
+
+        With a concurrency greater than one, up to that many pages (but never
+        more than MAX_PAGE_CONCURRENCY) are fetched at the same time, and each
+        page is parsed as soon as it arrives.
+
+        Pages which share a path are fetched and parsed only once, and all of
+        them are loaded even if only one of them was asked for.
+        '''
+        paths = self.getPagesByPath(pages)
+        if not paths:
+            return
 
-                response = requests.get(url, auth=auth, timeout=10, params=params)
-                response.raise_for_status()
+        concurrency = max(1, min(concurrency, MAX_PAGE_CONCURRENCY))
+        if concurrency == 1:
+            for path, pages in paths.items():
+                self.parsePages(pages, self.fetchPath(path))
 
-            # cleanly handle password updates in the middle of updating settings
-            if page.passwordWasChanged():
-                logging.debug('Password was changed, updating password used to access device')
-                self.password = page.getNewPassword()
+            return
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(self.fetchPath, path): pages for path, pages in paths.items()}
+            for future in as_completed(futures):
+                self.parsePages(futures[future], future.result())
+
+    def comparePlan(self, plan):
+        '''
+        Compare the changed settings in an UpdatePlan with the settings loaded
+        from the device, and return a list of VerifyMismatch for every setting
+        which does not have the planned value. Settings which the device does
+        not show (passwords) are skipped.
+        '''
+        mismatches = []
+        for write in plan.writes:
+            page = self.findPages([write.page, ])
+            if not page:
+                raise RuntimeError('Update plan page {} does not exist on this device'.format(write.page))
+
+            settings = {elem.name: elem for elem in page[0].settings}
+            for name, change in write.changes.items():
+                elem = settings.get(name)
+                if elem is None:
+                    raise RuntimeError('Update plan setting {} does not exist on page {}'.format(name, write.page))
+
+                if not elem.canReadBack():
+                    continue
+
+                actual = elem.convertValueToHumanFormat(elem.deviceValue)
+                if actual != change['update']:
+                    mismatches.append(VerifyMismatch(write.page, name, change['update'], actual))
+
+        return mismatches
+
+    @timed('verify')
+    def verifyPlan(self, plan, concurrency=1):
+        '''
+        Verify that an UpdatePlan was written to the device: fetch only the
+        pages which were written (up to concurrency at the same time), and
+        compare only the changed settings (see comparePlan()).
+        '''
+        self.loadPages(self.findPages(write.page for write in plan.writes), concurrency)
+        return self.comparePlan(plan)
+
+    def writeToDevice(self):
+        '''Write all updated settings from this object onto the device (see planUpdate())'''
+        plan = self.planUpdate()
+        if not plan.needsUpdate():
+            raise RuntimeError('You called writeToDevice() on a device without updates')
+
+        self.writePlan(plan)
 
     def needsUpdate(self):
         '''Check if the device needs any settings saved back to it'''
-        for page in self.pages:
-            if page.needsUpdate():
-                return True
-
-        return False
+        return len(self.changed) > 0
 
     def toDict(self):
-        '''Build a nested dictionary representing this device'''
+        '''Build a nested dictionary representing the loaded pages of this device'''
+        self.loadMissingPages(self.pages)
+
         data = OrderedDict()
         for page in self.pages:
-            data.update(page.toDict())
+            if page.loaded:
+                data.update(page.toDict())
 
         return data
 
     def fromDict(self, data):
         '''Update a device from a nested dictionary representing this device'''
-        for page in self.pages:
-            if page.name in data:
-                page.fromDict(data[page.name])
+        pages = self.findPages(data)
+        self.loadMissingPages(pages)
+
+        for page in pages:
+            page.fromDict(data[page.name])
+
+    def toDiffDict(self):
+        '''Build a nested dictionary of changed settings on this device'''
+        data = OrderedDict()
+        for page in self.getChangedPages():
+            data.update(page.toDiffDict())
+
+        return data
 
     def printDiff(self):
         '''Print a YAML-like unified diff of changed settings'''
-        if self.needsUpdate():
-            for page in self.pages:
-                page.printDiff()
+        for page in self.getChangedPages():
+            page.printDiff()
 
 def main():
     pass
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+from collections import namedtuple
+
+# Structure to hold one <option> of a <select> element
+FormOption = namedtuple('FormOption', [
+    'attrs',
+    'text',
+])
+
+class FormIndex(object):
+    '''
+    Index of the form controls (<input> and <select> elements) in an HTML
+    page, built in a single pass over the document.
+
+    Every setting on a page looks up its own form controls by name, so this
+    turns each lookup into a dictionary access instead of a scan of the whole
+    document.
+    '''
+    def __init__(self):
+        # (name, type) -> list of attribute dictionaries
+        self.inputsByName = {}
+        # name -> list of lists of FormOption
+        self.selectsByName = {}
+
+    def addInput(self, attrs):
+        '''Add an <input> element, given its attribute dictionary'''
+        key = (attrs.get('name'), attrs.get('type'))
+        self.inputsByName.setdefault(key, []).append(attrs)
+
+    def addSelect(self, attrs, options):
+        '''Add a <select> element, given its attributes and list of FormOption'''
+        self.selectsByName.setdefault(attrs.get('name'), []).append(options)
+
+    def inputs(self, name, type):
+        '''Return the attribute dictionaries of all <input> elements with this name and type'''
+        return self.inputsByName.get((name, type), [])
+
+    def selects(self, name):
+        '''Return the options of all <select> elements with this name'''
+        return self.selectsByName.get(name, [])
+
+    @classmethod
+    def fromSoup(cls, soup):
+        '''Build the index from a BeautifulSoup document'''
+        index = cls()
+        for element in soup.find_all(name=['input', 'select']):
+            if element.name == 'input':
+                index.addInput(element.attrs)
+                continue
+
+            options = [FormOption(option.attrs, option.text) for option in element.find_all(name='option')]
+            index.addSelect(element.attrs, options)
+
+        return index
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
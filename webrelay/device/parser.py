@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+'''
+Pluggable HTML parser backends.
+
+Each backend turns the raw content of a WebRelay page into a FormIndex (for
+the configuration pages) and into the text of selected elements (for the
+version information page). The Setting_* classes only ever see a FormIndex,
+so they work unchanged with any backend.
+
+Available backends:
+- html.parser: BeautifulSoup with the Python html.parser (the original)
+- lxml: lxml.html, if it is installed (only when requested)
+- stream: a streaming extractor on html.parser.HTMLParser events, which only
+  captures form controls and text without building a document tree
+
+The firmware leaves <option> elements unclosed. html.parser (and so the
+stream backend) reads the text of such an option up to the end of the
+<select>, for example 'OffOnLast', while lxml closes it at the next option
+('Off'). The option text names the values of Setting_Select, so lxml would
+not match existing configurations, and is never picked by default.
+'''
+
+from __future__ import print_function
+
+from webrelay.device.form import FormIndex
+from webrelay.device.form import FormOption
+
+from collections import OrderedDict
+
+import html.parser
+import bs4
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+# Backend used when none is requested: the fastest one which reads options the same way as html.parser
+DEFAULT_PARSER = 'stream'
+
+# Elements which never have an end tag (the same list as BeautifulSoup uses)
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta', 'param',
+    'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer',
+])
+
+def decode_content(content):
+    '''Decode the raw bytes of a page into a Python string'''
+    if isinstance(content, str):
+        return content
+
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return content.decode('latin-1')
+
+class Parser_Base(object):
+    '''
+    Base class for HTML parser backends.
+    '''
+    name = None
+
+    def parseForm(self, content):
+        '''Build a FormIndex of all form controls in the page'''
+        raise RuntimeError('You forgot to implement the parseForm() method')
+
+    def parseText(self, content, tags):
+        '''
+        Return a dictionary of tag name -> list of the text content of every
+        element with that tag name, in document order.
+        '''
+        raise RuntimeError('You forgot to implement the parseText() method')
+
+class Parser_BeautifulSoup(Parser_Base):
+    '''
+    BeautifulSoup with the Python html.parser. This builds a complete tree
+    of the document.
+    '''
+    name = 'html.parser'
+
+    def parseForm(self, content):
+        soup = bs4.BeautifulSoup(content, 'html.parser')
+        return FormIndex.fromSoup(soup)
+
+    def parseText(self, content, tags):
+        soup = bs4.BeautifulSoup(content, 'html.parser')
+        return {tag: [element.text for element in soup.find_all(name=tag)] for tag in tags}
+
+class Parser_Lxml(Parser_Base):
+    '''
+    The lxml.html parser (libxml2). This builds a complete tree of the
+    document, but much faster than BeautifulSoup does. Unclosed <option>
+    elements end at the next option, so their text differs from html.parser.
+    '''
+    name = 'lxml'
+
+    def __init__(self):
+        if lxml is None:
+            raise RuntimeError('The lxml parser backend requires the lxml package')
+
+    def parseDocument(self, content):
+        if not content.strip():
+            return lxml.html.fromstring('<html></html>')
+
+        return lxml.html.fromstring(content)
+
+    def parseForm(self, content):
+        root = self.parseDocument(content)
+
+        form = FormIndex()
+        for element in root.iter('input', 'select'):
+            attrs = dict(element.attrib)
+            if element.tag == 'input':
+                form.addInput(attrs)
+                continue
+
+            options = [FormOption(dict(option.attrib), option.text_content()) for option in element.iter('option')]
+            form.addSelect(attrs, options)
+
+        return form
+
+    def parseText(self, content, tags):
+        root = self.parseDocument(content)
+        return {tag: [element.text_content() for element in root.iter(tag)] for tag in tags}
+
+class OpenElement(object):
+    '''
+    An element which is still open in the StreamingExtractor. Elements which
+    are captured collect their text until they are closed.
+    '''
+    def __init__(self, tag, options=None):
+        self.tag = tag
+        self.parts = []
+        self.callbacks = []
+        # for <select> elements, the list of FormOption being filled in
+        self.options = options
+
+    def finish(self):
+        '''Hand the complete text of this element to everyone waiting for it'''
+        if not self.callbacks:
+            return
+
+        text = ''.join(self.parts)
+        for callback in self.callbacks:
+            callback(text)
+
+def reserve(results, factory):
+    '''
+    Reserve a place in the results list, so that elements are recorded in
+    document (start tag) order even though they are completed in end tag
+    order. Return the callback which fills in the reserved place.
+    '''
+    results.append(None)
+    index = len(results) - 1
+
+    def callback(text):
+        results[index] = factory(text)
+
+    return callback
+
+class StreamingExtractor(html.parser.HTMLParser):
+    '''
+    Capture the form controls, and the text of the requested elements, from
+    the stream of parser events without building a document tree.
+
+    Unclosed elements are handled the same way as BeautifulSoup does with
+    html.parser: an element stays open until its own end tag (or the end of
+    the document) or the end tag of an element which encloses it, and its
+    text includes the text of all nested elements.
+    '''
+    def __init__(self, tags=()):
+        super().__init__(convert_charrefs=True)
+        self.form = FormIndex()
+        self.tags = frozenset(tags)
+        self.texts = {tag: [] for tag in tags}
+
+        # all open elements, and the open elements which collect their text
+        self.stack = []
+        self.collecting = []
+
+    def convertAttrs(self, attrs):
+        '''Convert the attribute list into a dictionary, like BeautifulSoup'''
+        return {key: '' if value is None else value for key, value in attrs}
+
+    def findOpen(self, tag):
+        '''Return the innermost open element with this tag, if any'''
+        for element in reversed(self.stack):
+            if element.tag == tag:
+                return element
+
+        return None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'input':
+            self.form.addInput(self.convertAttrs(attrs))
+            return
+
+        if tag in VOID_ELEMENTS:
+            return
+
+        element = OpenElement(tag)
+        if tag == 'select':
+            element.options = []
+            self.form.addSelect(self.convertAttrs(attrs), element.options)
+        elif tag == 'option':
+            select = self.findOpen('select')
+            if select is not None:
+                attrs = self.convertAttrs(attrs)
+                element.callbacks.append(reserve(select.options, lambda text: FormOption(attrs, text)))
+
+        if tag in self.tags:
+            element.callbacks.append(reserve(self.texts[tag], lambda text: text))
+
+        self.stack.append(element)
+        if element.callbacks:
+            self.collecting.append(element)
+
+    def handle_endtag(self, tag):
+        element = self.findOpen(tag)
+        if element is None:
+            return
+
+        # close everything up to and including that element
+        while True:
+            closed = self.popElement()
+            if closed is element:
+                break
+
+    def handle_data(self, data):
+        for element in self.collecting:
+            element.parts.append(data)
+
+    def popElement(self):
+        '''Close the innermost open element'''
+        element = self.stack.pop()
+        if element.callbacks:
+            self.collecting.pop()
+            element.finish()
+
+        return element
+
+    def close(self):
+        super().close()
+        while self.stack:
+            self.popElement()
+
+class Parser_Stream(Parser_Base):
+    '''
+    Streaming extractor built on html.parser.HTMLParser events.
+    '''
+    name = 'stream'
+
+    def extract(self, content, tags):
+        extractor = StreamingExtractor(tags)
+        extractor.feed(decode_content(content))
+        extractor.close()
+        return extractor
+
+    def parseForm(self, content):
+        return self.extract(content, ()).form
+
+    def parseText(self, content, tags):
+        return self.extract(content, tags).texts
+
+# All parser backends, by name
+PARSERS = OrderedDict([
+    (Parser_BeautifulSoup.name, Parser_BeautifulSoup),
+    (Parser_Lxml.name, Parser_Lxml),
+    (Parser_Stream.name, Parser_Stream),
+])
+
+# Parser instances are stateless, so they are created once and shared
+_instances = {}
+
+def available_parsers():
+    '''Return the names of all parser backends usable in this environment'''
+    return [name for name in PARSERS if name != Parser_Lxml.name or lxml is not None]
+
+def set_default_parser(name):
+    '''Set the parser backend used when none is requested'''
+    global DEFAULT_PARSER
+
+    if name not in PARSERS:
+        raise RuntimeError('Unknown parser backend {}'.format(name))
+
+    DEFAULT_PARSER = name
+
+def get_parser(name=None):
+    '''Return the parser backend with this name (default: DEFAULT_PARSER)'''
+    if name is None:
+        name = DEFAULT_PARSER
+
+    if name not in _instances:
+        if name not in PARSERS:
+            raise RuntimeError('Unknown parser backend {}'.format(name))
+
+        _instances[name] = PARSERS[name]()
+
+    return _instances[name]
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -2,6 +2,84 @@
 
 from __future__ import print_function
 from collections import OrderedDict
+from collections import namedtuple
+
+from webrelay.device.form import FormIndex
+
+from types import MappingProxyType
+
+# The password pages show this instead of the current password
+PASSWORD_PLACEHOLDER = '0000000000'
+
+# Structure to hold the immutable description of a setting, shared by every
+# device of the same model (see setting_schema())
+SettingSchema = namedtuple('SettingSchema', [
+    'type',
+    'name',
+    'formName',
+])
+
+# (type, name, formName) -> SettingSchema
+_setting_schemas = {}
+
+def setting_schema(type, name, formName):
+    '''Return the shared SettingSchema of a setting, creating it on first use'''
+    # IP settings have several form names
+    if isinstance(formName, list):
+        formName = tuple(formName)
+
+    key = (type, name, formName)
+    schema = _setting_schemas.get(key)
+    if schema is None:
+        schema = _setting_schemas.setdefault(key, SettingSchema(type, name, formName))
+
+    return schema
+
+class OptionTable(object):
+    '''
+    Immutable two-way map between the human-readable and device values of
+    the options of a select or radio setting.
+
+    Identical tables are shared (see option_table()), so the same options
+    on many pages of many devices are held in memory only once.
+    '''
+    __slots__ = ('deviceMap', 'humanMap')
+
+    def __init__(self, pairs):
+        deviceMap = OrderedDict(pairs)
+        self.deviceMap = MappingProxyType(deviceMap)
+        self.humanMap = MappingProxyType({v: k for k, v in deviceMap.items()})
+
+    def toHuman(self, name, value):
+        '''Convert a device value of the setting with this name into human-readable format'''
+        try:
+            return self.humanMap[value]
+        except KeyError:
+            raise RuntimeError('Unknown device value {!r} for setting {}, expected one of: {}'.format(
+                value, name, ', '.join(repr(v) for v in self.humanMap)))
+
+    def toDevice(self, name, value):
+        '''Convert a human-readable value of the setting with this name into device format'''
+        try:
+            return self.deviceMap[value]
+        except (KeyError, TypeError):
+            raise RuntimeError('Unknown value {!r} for setting {}, choose from: {}'.format(
+                value, name, ', '.join(repr(k) for k in self.deviceMap)))
+
+# tuple of (human, device) pairs -> OptionTable
+_option_tables = {}
+
+def option_table(pairs):
+    '''Return the shared OptionTable of a sequence of (human, device) value pairs, creating it on first use'''
+    key = tuple((human, device) for human, device in pairs)
+    table = _option_tables.get(key)
+    if table is None:
+        table = _option_tables.setdefault(key, OptionTable(key))
+
+    return table
+
+# An empty OptionTable, for select settings which have not been loaded
+EMPTY_OPTIONS = option_table([])
 
 def strtruncate(s, maxlength):
     '''
@@ -25,21 +103,68 @@ def exactly_one_element(result, elementtype, name):
 class Setting_Base(object):
     '''
     Base class for WebRelay Settings
+
+    The name and form name are kept in a SettingSchema shared by every device
+    of the same model, and the values of each device in __slots__, so that
+    many devices can be held in memory at once.
     '''
+    __slots__ = ('schema', 'owner', 'index', 'dirty', '_deviceValue', '_updateValue')
+
     def __init__(self, name, formName):
-        self.name = name
-        self.formName = formName
+        self.schema = setting_schema(type(self), name, formName)
+
+        # Page holding this setting (notified whenever needsUpdate() changes),
+        # and the position of this setting on the page
+        self.owner = None
+        self.index = 0
+
+        # Does the updated setting differ from the current setting?
+        self.dirty = False
 
         # Value on the device (current setting)
-        self.deviceValue = None
+        self._deviceValue = None
         # Value that the user wants to set (updated setting)
-        self.updateValue = None
+        self._updateValue = None
 
     def __repr__(self):
         return repr(self.name)
 
+    @property
+    def name(self):
+        return self.schema.name
+
+    @property
+    def formName(self):
+        return self.schema.formName
+
+    @property
+    def deviceValue(self):
+        return self._deviceValue
+
+    @deviceValue.setter
+    def deviceValue(self, value):
+        self._deviceValue = value
+        self.updateDirty()
+
+    @property
+    def updateValue(self):
+        return self._updateValue
+
+    @updateValue.setter
+    def updateValue(self, value):
+        self._updateValue = value
+        self.updateDirty()
+
+    def updateDirty(self):
+        '''Recompute whether this setting needs an update, and tell the owner page if that changed'''
+        dirty = not (self._deviceValue == self._updateValue)
+        if dirty != self.dirty:
+            self.dirty = dirty
+            if self.owner is not None:
+                self.owner.settingChanged(self)
+
     def needsUpdate(self):
-        return not (self.deviceValue == self.updateValue)
+        return self.dirty
 
     def getUpdateParams(self):
         if not self.needsUpdate():
@@ -59,7 +184,28 @@ class Setting_Base(object):
 
     def fromSoup(self, soup):
         '''Fetch the information about this setting from the HTML soup'''
-        raise RuntimeError('You forgot to implement the fromSoup() method')
+        self.fromForm(FormIndex.fromSoup(soup))
+
+    def fromForm(self, form):
+        '''Fetch the information about this setting from the FormIndex of the page'''
+        raise RuntimeError('You forgot to implement the fromForm() method')
+
+    def canReadBack(self):
+        '''Does the device show the current value of this setting, so that an update can be verified?'''
+        return True
+
+    def isSecret(self):
+        '''Must the value of this setting be kept out of log messages?'''
+        return False
+
+    def saveState(self):
+        '''Return the state loaded by fromForm() as JSON-serializable data'''
+        return OrderedDict([('deviceValue', self.deviceValue), ])
+
+    def restoreState(self, state):
+        '''Restore the state saved by saveState(), exactly as if fromForm() had run again'''
+        self.deviceValue = state['deviceValue']
+        self.updateValue = self.deviceValue
 
     def toDict(self):
         '''Build a nested dictionary representing this setting'''
@@ -70,32 +216,38 @@ class Setting_Base(object):
         '''Set the new value (updated setting) in human-readable format'''
         self.updateValue = self.convertValueToDeviceFormat(value)
 
+    def toDiffDict(self):
+        '''Build a nested dictionary of the device and updated values, if changed'''
+        data = OrderedDict()
+        if self.needsUpdate():
+            data[self.name] = OrderedDict([
+                ('device', self.convertValueToHumanFormat(self.deviceValue)),
+                ('update', self.convertValueToHumanFormat(self.updateValue)),
+            ])
+
+        return data
+
     def printDiff(self):
         '''Print a YAML-like unified diff of changed settings'''
         if self.needsUpdate():
             print('- {}: {}'.format(self.name, self.convertValueToHumanFormat(self.deviceValue)))
             print('+ {}: {}'.format(self.name, self.convertValueToHumanFormat(self.updateValue)))
 
-    def fromSoup(self, soup):
-        raise RuntimeError('You forgot to implement the fromSoup() method')
-
 class Setting_Checkbox(Setting_Base):
     '''
     Class to handle a WebRelay check box setting.
     '''
+    __slots__ = ()
+
     def __init__(self, name, formName):
         super().__init__(name, formName)
 
-    def fromSoup(self, soup):
-        attrs = {}
-        attrs['name'] = self.formName
-        attrs['type'] = 'checkbox'
-
-        result = soup.find_all(name='input', attrs=attrs)
+    def fromForm(self, form):
+        result = form.inputs(self.formName, 'checkbox')
         exactly_one_element(result, 'input', self.formName)
 
         result = result[0]
-        self.deviceValue = result.has_attr('checked')
+        self.deviceValue = 'checked' in result
         self.updateValue = self.deviceValue
 
 class Setting_IP(Setting_Base):
@@ -107,17 +259,15 @@ class Setting_IP(Setting_Base):
     with their own form name (this varies significantly between each
     hardware variant).
     '''
+    __slots__ = ()
+
     def __init__(self, name, formName):
         super().__init__(name, formName)
 
-    def fromSoup(self, soup):
+    def fromForm(self, form):
         ip = []
         for elem in self.formName:
-            attrs = {}
-            attrs['name'] = elem
-            attrs['type'] = 'text'
-
-            result = soup.find_all(name='input', attrs=attrs)
+            result = form.inputs(elem, 'text')
             exactly_one_element(result, 'input', elem)
             ip.append(result[0]['value'])
 
@@ -132,38 +282,50 @@ class Setting_Select(Setting_Base):
     '''
     Class to handle a WebRelay select setting (a combo box).
     '''
+    __slots__ = ('options', )
+
     def __init__(self, name, formName):
         super().__init__(name, formName)
-        self.deviceMap = {}
+        self.options = EMPTY_OPTIONS
+
+    @property
+    def deviceMap(self):
+        '''Map of each option presented by the device, from Human format to Device format'''
+        return self.options.deviceMap
 
     def convertValueToHumanFormat(self, value):
-        humanMap = {v: k for k, v in self.deviceMap.items()}
-        return humanMap[value]
+        return self.options.toHuman(self.name, value)
 
     def convertValueToDeviceFormat(self, value):
-        return self.deviceMap[value]
-
-    def fromSoup(self, soup):
-        attrs = {}
-        attrs['name'] = self.formName
+        return self.options.toDevice(self.name, value)
 
-        result = soup.find_all(name='select', attrs=attrs)
+    def fromForm(self, form):
+        result = form.selects(self.formName)
         exactly_one_element(result, 'select', self.formName)
 
-        # remove any old data from the deviceMap
-        self.deviceMap.clear()
-
-        # fill the deviceMap with all options presented by the device
+        # all options presented by the device, shared with identical selects
         result = result[0]
-        for option in result.find_all(name='option'):
-            option_value = option['value']
+        pairs = []
+        for option in result:
+            option_value = option.attrs['value']
             option_text = option.text
-            self.deviceMap[option_text] = option_value
+            pairs.append((option_text, option_value))
 
-            if option.has_attr('selected'):
+            if 'selected' in option.attrs:
                 self.deviceValue = option_value
                 self.updateValue = self.deviceValue
 
+        self.options = option_table(pairs)
+
+    def saveState(self):
+        state = super().saveState()
+        state['deviceMap'] = list(self.deviceMap.items())
+        return state
+
+    def restoreState(self, state):
+        super().restoreState(state)
+        self.options = option_table(state['deviceMap'])
+
 class Setting_Text(Setting_Base):
     '''
     Class to handle a WebRelay text setting (text input box).
@@ -171,27 +333,34 @@ class Setting_Text(Setting_Base):
     It automatically truncates the length of any updated settings to the
     length specified by the device.
     '''
+    __slots__ = ('maxLength', )
+
     def __init__(self, name, formName):
         super().__init__(name, formName)
         self.maxLength = None
 
-    def fromSoup(self, soup):
-        attrs = {}
-        attrs['name'] = self.formName
-        attrs['type'] = 'text'
-
-        result = soup.find_all(name='input', attrs=attrs)
+    def fromForm(self, form):
+        result = form.inputs(self.formName, 'text')
         exactly_one_element(result, 'input', self.formName)
         result = result[0]
 
         # save maximum length if available
-        if result.has_attr('maxlength'):
+        if 'maxlength' in result:
             self.maxLength = int(result['maxlength'])
 
         # save value from device
         self.deviceValue = result['value']
         self.updateValue = self.deviceValue
 
+    def saveState(self):
+        state = super().saveState()
+        state['maxLength'] = self.maxLength
+        return state
+
+    def restoreState(self, state):
+        super().restoreState(state)
+        self.maxLength = state['maxLength']
+
 class Setting_Password(Setting_Base):
     '''
     Class to handle a WebRelay password setting (text input box).
@@ -202,31 +371,59 @@ class Setting_Password(Setting_Base):
     The password is optional, and only needed if this password is the
     password that controls access to the configuration pages.
     '''
+    __slots__ = ('maxLength', 'password', 'formValue')
+
     def __init__(self, name, formName, password=None):
         super().__init__(name, formName)
         self.maxLength = None
         self.password = password
 
-    def fromSoup(self, soup):
-        attrs = {}
-        attrs['name'] = self.formName
-        attrs['type'] = 'password'
+        # value in the HTML form, before the placeholder is replaced
+        self.formValue = None
 
-        result = soup.find_all(name='input', attrs=attrs)
+    def fromForm(self, form):
+        result = form.inputs(self.formName, 'password')
         exactly_one_element(result, 'input', self.formName)
         result = result[0]
 
         # save maximum length if available
-        if result.has_attr('maxlength'):
+        if 'maxlength' in result:
             self.maxLength = int(result['maxlength'])
 
         # value from the HTML form
         value = result['value']
 
+        self.formValue = value
+
         # the device doesn't actually send the current password, it sends
         # a string of zeroes. Don't save this non-setting. Instead save
         # the real password used for authentication.
-        if value == '0000000000':
+        if value == PASSWORD_PLACEHOLDER:
+            value = self.password
+
+        self.deviceValue = value
+        self.updateValue = self.deviceValue
+
+    def canReadBack(self):
+        # the device only ever shows the placeholder
+        return False
+
+    def isSecret(self):
+        return True
+
+    def saveState(self):
+        # save the value from the HTML form, so the real password is never saved
+        return OrderedDict([
+            ('formValue', self.formValue),
+            ('maxLength', self.maxLength),
+        ])
+
+    def restoreState(self, state):
+        self.formValue = state['formValue']
+        self.maxLength = state['maxLength']
+
+        value = self.formValue
+        if value == PASSWORD_PLACEHOLDER:
             value = self.password
 
         self.deviceValue = value
@@ -241,28 +438,36 @@ class Setting_Radio(Setting_Base):
     device. This is difficult or impossible due to the way radio buttons
     were implemented.
     '''
+    __slots__ = ()
 
     # Map each possible radio button setting from Human format to
     # Device format. This should be overridden by subclasses to have
     # the specific options supported by the device.
     deviceMap = {}
 
+    # OptionTable of each subclass, built from the deviceMap on first use
+    _optionTables = {}
+
     def __init__(self, name, formName):
         super().__init__(name, formName)
 
+    @classmethod
+    def getOptions(cls):
+        '''Return the OptionTable of the deviceMap of this class'''
+        table = cls._optionTables.get(cls)
+        if table is None:
+            table = cls._optionTables.setdefault(cls, option_table(cls.deviceMap.items()))
+
+        return table
+
     def convertValueToHumanFormat(self, value):
-        humanMap = {v: k for k, v in self.deviceMap.items()}
-        return humanMap[value]
+        return self.getOptions().toHuman(self.name, value)
 
     def convertValueToDeviceFormat(self, value):
-        return self.deviceMap[value]
-
-    def fromSoup(self, soup):
-        attrs = {}
-        attrs['name'] = self.formName
-        attrs['type'] = 'radio'
+        return self.getOptions().toDevice(self.name, value)
 
-        result = soup.find_all(name='input', attrs=attrs)
+    def fromForm(self, form):
+        result = form.inputs(self.formName, 'radio')
         if len(result) <= 0:
             raise RuntimeError('Unable to find input radio element with name: {}'.format(self.formName))
 
@@ -274,7 +479,7 @@ class Setting_Radio(Setting_Base):
 
         for idx, elem in enumerate(result):
             # skip un-selected elements
-            if 'checked' not in elem.attrs:
+            if 'checked' not in elem:
                 continue
 
             # save the device value from the HTML
@@ -285,18 +490,21 @@ class Setting_Radio(Setting_Base):
             raise RuntimeError('Unable to find checked input radio element with name: {}'.format(self.formName))
 
 class Setting_YesNo(Setting_Radio):
+    __slots__ = ()
     deviceMap = {
         'Yes': 'yes',
         'No': 'no',
     }
 
 class Setting_TwoColor(Setting_Radio):
+    __slots__ = ()
     deviceMap = {
         'Gr': 'green',
         'Rd': 'red',
     }
 
 class Setting_FourColor(Setting_Radio):
+    __slots__ = ()
     deviceMap = {
         'Gr': 'green',
         'Rd': 'red',
@@ -305,6 +513,7 @@ class Setting_FourColor(Setting_Radio):
     }
 
 class Setting_NumButtons(Setting_Radio):
+    __slots__ = ()
     deviceMap = {
         '0': 'zero',
         '1': 'one',
@@ -312,24 +521,28 @@ class Setting_NumButtons(Setting_Radio):
     }
 
 class Setting_RelayMode(Setting_Radio):
+    __slots__ = ()
     deviceMap = {
         'Standard': 'relay',
         'Automatic Reboot': 'reboot',
     }
 
 class Setting_Netspeed(Setting_Radio):
+    __slots__ = ()
     deviceMap = {
         '10 Mbps': 'ten',
         '100 Mbps': 'hundred',
     }
 
 class Setting_Netmode(Setting_Radio):
+    __slots__ = ()
     deviceMap = {
         'Half Duplex': 'half',
         'Full Duplex': 'full',
     }
 
 class Setting_EmailLength(Setting_Radio):
+    __slots__ = ()
     deviceMap = {
         'Full Message': '0',
         'Short Message': '1',
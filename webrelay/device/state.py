@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+'''
+Live state of the relays and inputs of a WebRelay device.
+
+Every model serves its current state as a small XML document (state.xml),
+with one element per relay and input holding 0 or 1. The document is read in
+a single request, and parsed with ElementTree rather than BeautifulSoup, so
+that the state of many devices can be polled quickly.
+
+The same document controls the relays: each query parameter of the request
+turns one relay off (0), on (1) or pulses it (2), and the response is the
+state after the commands were carried out. Some models accept commands for
+several relays in one request, up to the batch size of their StateLayout.
+'''
+
+from __future__ import print_function
+
+from collections import OrderedDict
+from collections import namedtuple
+
+import xml.etree.ElementTree as ElementTree
+import time
+
+# Path of the state document, on every model
+STATE_PATH = '/state.xml'
+
+# Structure to describe the state document of one model: the element names
+# of the relays and of the inputs, the query parameter names which control
+# each relay, in order, and the maximum number of relays in one request
+StateLayout = namedtuple('StateLayout', [
+    'relays',
+    'inputs',
+    'commands',
+    'batchSize',
+])
+
+# Structure to hold the state of a device at one time: a tuple of booleans
+# for the relays and the inputs (relay 1 first), and when it was read
+RelayState = namedtuple('RelayState', [
+    'hostname',
+    'timestamp',
+    'relays',
+    'inputs',
+])
+
+# Structure to hold one command: the relay number (starting at 1) and one of the RELAY_ACTIONS
+RelayCommand = namedtuple('RelayCommand', [
+    'relay',
+    'action',
+])
+
+# Relay actions, and the values of their query parameters
+RELAY_ACTIONS = OrderedDict([
+    ('off', '0'),
+    ('on', '1'),
+    ('pulse', '2'),
+])
+
+def numbered_tags(format, count):
+    '''Return the element names of count numbered relays or inputs, starting at 1'''
+    return tuple(format.format(number) for number in range(1, count + 1))
+
+def parse_state(layout, content, hostname=None, timestamp=None):
+    '''
+    Parse the raw content of a state document into a RelayState. Raise
+    RuntimeError if it is not valid XML, or a relay or input is missing.
+    '''
+    if timestamp is None:
+        timestamp = time.time()
+
+    try:
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError as ex:
+        raise RuntimeError('Invalid state document from {}: {}'.format(hostname, str(ex)))
+
+    values = {elem.tag: elem.text for elem in root}
+    relays = tuple(parse_state_value(values, tag, hostname) for tag in layout.relays)
+    inputs = tuple(parse_state_value(values, tag, hostname) for tag in layout.inputs)
+
+    return RelayState(hostname, timestamp, relays, inputs)
+
+def parse_state_value(values, tag, hostname):
+    '''Parse the 0 / 1 value of one relay or input'''
+    value = values.get(tag)
+    if value is None:
+        raise RuntimeError('State document from {} is missing {}'.format(hostname, tag))
+
+    value = value.strip()
+    if value not in ('0', '1'):
+        raise RuntimeError('State document from {} has invalid {}: {}'.format(hostname, tag, value))
+
+    return value == '1'
+
+def plan_commands(layout, commands):
+    '''
+    Group relay commands into as few requests as the model permits, in
+    order. Return the query parameters of each request. A relay which is
+    commanded again starts a new request, so that no command is lost.
+    '''
+    batches = []
+    params = OrderedDict()
+    for command in commands:
+        relay, action = command
+        if not 1 <= relay <= len(layout.commands):
+            raise RuntimeError('Relay {} does not exist, choose from: 1-{}'.format(relay, len(layout.commands)))
+
+        if action not in RELAY_ACTIONS:
+            raise RuntimeError('Unknown relay action {}, choose from: {}'.format(action, ', '.join(RELAY_ACTIONS)))
+
+        name = layout.commands[relay - 1]
+        if name in params or len(params) >= layout.batchSize:
+            batches.append(params)
+            params = OrderedDict()
+
+        params[name] = RELAY_ACTIONS[action]
+
+    if params:
+        batches.append(params)
+
+    return batches
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
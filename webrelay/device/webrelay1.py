@@ -5,6 +5,8 @@ from __future__ import print_function
 from webrelay.device.base import WebRelay_Page
 from webrelay.device.base import WebRelay_Base
 
+from webrelay.device.state import StateLayout
+
 from webrelay.device.settings import Setting_IP
 from webrelay.device.settings import Setting_Text
 from webrelay.device.settings import Setting_Netspeed
@@ -119,11 +121,12 @@ class WebRelay1(WebRelay_Base):
     # passwordSetup.html
     # relaySetup.html
     # indexSetup.html
+    # state.xml
     '''
-    def __init__(self, hostname, username, password):
-        self.hostname = hostname
-        self.username = username
-        self.password = password
+    stateLayout = StateLayout(('relaystate', ), ('inputstate', ), ('relayState', ), 1)
+
+    def __init__(self, hostname, username, password, session=None):
+        super().__init__(hostname, username, password, session)
         self.pages = [
             NetworkPage(),
             PasswordPage(username, password),
@@ -5,6 +5,9 @@ from __future__ import print_function
 from webrelay.device.base import WebRelay_Page
 from webrelay.device.base import WebRelay_Base
 
+from webrelay.device.state import StateLayout
+from webrelay.device.state import numbered_tags
+
 from webrelay.device.settings import Setting_IP
 from webrelay.device.settings import Setting_Text
 from webrelay.device.settings import Setting_Netspeed
@@ -108,11 +111,12 @@ class WebRelay4(WebRelay_Base):
     # relay2Setup.html
     # relay3Setup.html
     # relay4Setup.html
+    # state.xml
     '''
-    def __init__(self, hostname, username, password):
-        self.hostname = hostname
-        self.username = username
-        self.password = password
+    stateLayout = StateLayout(numbered_tags('relay{}state', 4), (), numbered_tags('relay{}State', 4), 1)
+
+    def __init__(self, hostname, username, password, session=None):
+        super().__init__(hostname, username, password, session)
         self.pages = [
             NetworkPage(),
             PasswordPage(username, password),
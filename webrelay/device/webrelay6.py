@@ -5,6 +5,9 @@ from __future__ import print_function
 from webrelay.device.base import WebRelay_Page
 from webrelay.device.base import WebRelay_Base
 
+from webrelay.device.state import StateLayout
+from webrelay.device.state import numbered_tags
+
 from webrelay.device.settings import Setting_IP
 from webrelay.device.settings import Setting_Text
 from webrelay.device.settings import Setting_Netspeed
@@ -124,9 +127,10 @@ class RelayPage(WebRelay_Page):
     def getUpdatePath(self):
         return '/relaychng.srv'.format(self.number)
 
-    def getUpdateParams(self):
-        params = super().getUpdateParams()
+    def getUpdateParams(self, settings=None):
+        params = super().getUpdateParams(settings)
         params.update({'rNum': self.number})
+        return params
 
 class ControlPage(WebRelay_Page):
     def __init__(self):
@@ -176,11 +180,12 @@ class WebRelay6(WebRelay_Base):
     # relaySetup.html -> relaychng.srv?rNum=6
     # scriptSetup.html
     # controlPageSetup.html
+    # state.xml
     '''
-    def __init__(self, hostname, username, password):
-        self.hostname = hostname
-        self.username = username
-        self.password = password
+    stateLayout = StateLayout(numbered_tags('relay{}state', 6), (), numbered_tags('relay{}State', 6), 6)
+
+    def __init__(self, hostname, username, password, session=None):
+        super().__init__(hostname, username, password, session)
         self.pages = [
             NetworkPage(),
             AdvancedNetworkPage(),
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+'''
+Run fetch / diff / update operations against a whole fleet of WebRelay
+devices concurrently.
+'''
+
+from __future__ import print_function
+
+from webrelay.utils import load_webrelay_device
+
+from webrelay.session import WebRelay_Session
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from collections import namedtuple
+from collections import OrderedDict
+
+import logging
+import time
+import sys
+
+# Structure to hold the result of a fleet operation on a single host
+FleetResult = namedtuple('FleetResult', [
+    'hostname',
+    'action',
+    'success',
+    'elapsed',
+    'model',
+    'serialNumber',
+    'data',
+    'error',
+])
+
+def read_inventory(filename):
+    '''
+    Read a list of hostnames from an inventory file: one hostname per line,
+    blank lines and comments (starting with '#') are ignored. A hostname
+    listed more than once (ignoring case) is only returned the first time.
+    '''
+    # read from stdin if requested
+    if filename == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(filename, 'r') as f:
+            lines = f.read().splitlines()
+
+    hostnames = OrderedDict()
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if line:
+            hostnames.setdefault(line.lower(), line)
+
+    return list(hostnames.values())
+
+def fleet_fetch(device, data):
+    '''Return the complete configuration of a loaded device'''
+    return device.toDict()
+
+def fleet_diff(device, data):
+    '''Compare the configuration of a loaded device with the configuration data'''
+    device.fromDict(data)
+    return device.toDiffDict()
+
+def fleet_update(device, data):
+    '''Write any changed settings from the configuration data to a loaded device'''
+    device.fromDict(data)
+
+    diff = device.toDiffDict()
+    if device.needsUpdate():
+        device.writeToDevice()
+
+    return diff
+
+# All operations supported in fleet mode
+FLEET_ACTIONS = OrderedDict([
+    ('fetch', fleet_fetch),
+    ('diff', fleet_diff),
+    ('update', fleet_update),
+])
+
+def run_host(hostname, action, data, auth, session, page_concurrency, cache, parse_cache):
+    '''
+    Run a single fleet operation against one host, capturing any error into
+    the result rather than raising it.
+    '''
+    func = FLEET_ACTIONS[action]
+    username, password, password_file = auth
+
+    start = time.time()
+    model = None
+    serialNumber = None
+    # a diff or update only needs the pages named in the configuration data
+    pages = None
+    if action != 'fetch' and data is not None:
+        pages = list(data)
+
+    try:
+        device = load_webrelay_device(hostname, username, password, password_file, session, page_concurrency,
+                                      cache, pages, parse_cache)
+        if device is None:
+            raise RuntimeError('unable to connect and authenticate')
+
+        model = device.versionInfo.modelNumber
+        serialNumber = device.versionInfo.serialNumber
+
+        result = func(device, data)
+        elapsed = time.time() - start
+        return FleetResult(hostname, action, True, elapsed, model, serialNumber, result, None)
+    except Exception as ex:
+        logging.debug('Host %s failed: %s', hostname, ex)
+        elapsed = time.time() - start
+        return FleetResult(hostname, action, False, elapsed, model, serialNumber, None, str(ex))
+
+def run_fleet(hostnames, action, data=None, username=None, password=None, password_file=None,
+              max_workers=8, page_concurrency=1, session=None, cache=None, parse_cache=None):
+    '''
+    Run an operation against many hosts concurrently, yielding a FleetResult
+    for each host as soon as it completes.
+
+    All hosts share a single HTTP session, which keeps a connection pool for
+    each host currently being worked on. Each host is worked on once, by a
+    single worker (a hostname listed twice is only run once), and up to
+    page_concurrency requests (credential tests or page fetches) are made at
+    once to each device.
+
+    With a DeviceCache, hosts found in the cache skip detection. With a
+    ParseCache, pages which did not change since the last run are not parsed
+    again. The caller is responsible for saving the caches afterwards.
+    '''
+    if action not in FLEET_ACTIONS:
+        raise RuntimeError('Unsupported fleet action {}'.format(action))
+
+    if max_workers < 1:
+        raise RuntimeError('Global concurrency limit must be at least 1')
+
+    auth = (username, password, password_file)
+
+    if session is None:
+        session = WebRelay_Session(pool_size=page_concurrency, pool_hosts=max_workers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for hostname in OrderedDict.fromkeys(hostnames):
+            future = executor.submit(run_host, hostname, action, data, auth, session, page_concurrency, cache,
+                                     parse_cache)
+            futures.append(future)
+
+        for future in as_completed(futures):
+            yield future.result()
+
+def summarize_results(results, elapsed):
+    '''
+    Build a machine-readable summary of a completed fleet run.
+    '''
+    succeeded = [r for r in results if r.success]
+    failed = [r for r in results if not r.success]
+    timings = sorted(r.elapsed for r in results)
+
+    summary = OrderedDict()
+    summary['total'] = len(results)
+    summary['succeeded'] = len(succeeded)
+    summary['failed'] = len(failed)
+    summary['elapsed'] = elapsed
+    summary['host_elapsed_min'] = timings[0] if timings else None
+    summary['host_elapsed_max'] = timings[-1] if timings else None
+    summary['host_elapsed_mean'] = sum(timings) / len(timings) if timings else None
+    summary['failures'] = OrderedDict((r.hostname, r.error) for r in failed)
+
+    return summary
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
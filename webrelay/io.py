@@ -4,36 +4,324 @@ from __future__ import print_function
 
 from collections import OrderedDict
 
+import itertools
+import gzip
+import json
 import yaml
 import sys
 
+# use the libyaml C implementation when it is available
+try:
+    from yaml import CSafeLoader as SafeLoader
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader
+    from yaml import SafeDumper
+
+# msgpack is optional, gzip compressed JSON Lines is the fallback
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Serialization formats of configuration files and snapshots
+FORMATS = ('yaml', 'json', 'jsonl', 'jsonl.gz', 'msgpack')
+
+# Filename extensions of each format
+FORMAT_EXTENSIONS = OrderedDict([
+    ('.yml', 'yaml'),
+    ('.yaml', 'yaml'),
+    ('.jsonl', 'jsonl'),
+    ('.ndjson', 'jsonl'),
+    ('.json', 'json'),
+    ('.jsonl.gz', 'jsonl.gz'),
+    ('.ndjson.gz', 'jsonl.gz'),
+    ('.json.gz', 'jsonl.gz'),
+    ('.msgpack', 'msgpack'),
+    ('.mpk', 'msgpack'),
+])
+
+# First bytes of a gzip file
+GZIP_MAGIC = b'\x1f\x8b'
+
+class OrderedLoader(SafeLoader):
+    '''Safe YAML loader which reads mappings as OrderedDict, keeping the order of the file'''
+    pass
+
+def _construct_ordered_mapping(loader, node):
+    loader.flatten_mapping(node)
+    return OrderedDict(loader.construct_pairs(node))
+
+OrderedLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, _construct_ordered_mapping)
+
 # https://stackoverflow.com/questions/5121931/in-python-how-can-you-load-yaml-mappings-as-ordereddicts
-def yaml_ordered_dump(data, stream=None, Dumper=yaml.Dumper, **kwds):
-    class OrderedDumper(Dumper):
-        pass
+def _dict_representer(dumper, data):
+    return dumper.represent_mapping(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, data.items())
+
+class OrderedDumper(SafeDumper):
+    '''Safe YAML dumper which writes OrderedDict as a plain mapping, in order'''
+    pass
+
+OrderedDumper.add_representer(OrderedDict, _dict_representer)
 
-    def _dict_representer(dumper, data):
-        return dumper.represent_mapping(
-            yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
-            data.items())
+# ordered subclasses of other Dumper classes, created on first use
+_ordered_dumpers = {SafeDumper: OrderedDumper, }
 
-    OrderedDumper.add_representer(OrderedDict, _dict_representer)
-    return yaml.dump(data, stream, OrderedDumper, **kwds)
+def ordered_dumper(Dumper):
+    '''Return the subclass of Dumper which writes OrderedDict as a plain mapping'''
+    if Dumper not in _ordered_dumpers:
+        class Ordered(Dumper):
+            pass
+
+        Ordered.add_representer(OrderedDict, _dict_representer)
+        _ordered_dumpers[Dumper] = Ordered
+
+    return _ordered_dumpers[Dumper]
+
+def yaml_ordered_dump(data, stream=None, Dumper=SafeDumper, **kwds):
+    return yaml.dump(data, stream, ordered_dumper(Dumper), sort_keys=False, **kwds)
 
 def dump_yaml(data):
-    return yaml_ordered_dump(data, Dumper=yaml.SafeDumper, default_flow_style=False)
+    return yaml_ordered_dump(data, default_flow_style=False)
 
 def read_yaml(stream):
-        return yaml.load(stream)
+    return yaml.load(stream, Loader=OrderedLoader)
+
+def write_yaml_document(document, stream):
+    '''Append one document to a multi-document YAML stream'''
+    yaml.dump(document, stream, OrderedDumper, default_flow_style=False, explicit_start=True, sort_keys=False)
+
+def write_yaml_documents(documents, stream):
+    '''
+    Write each item of an iterable as a separate YAML document to the
+    stream, as it is produced, without holding all of them in memory.
+    '''
+    yaml.dump_all(documents, stream, OrderedDumper, default_flow_style=False, explicit_start=True,
+                  sort_keys=False)
+
+def read_yaml_documents(stream):
+    '''Generate each document of a multi-document YAML stream, one at a time'''
+    return yaml.load_all(stream, Loader=OrderedLoader)
+
+def compact_format():
+    '''Return the most compact format available: msgpack if installed, otherwise gzip compressed JSON Lines'''
+    return 'msgpack' if msgpack is not None else 'jsonl.gz'
+
+def check_format(format):
+    '''Make sure a format is known, and that its optional package is installed'''
+    if format not in FORMATS:
+        raise RuntimeError('Unknown format {}, choose from: {}'.format(format, ', '.join(FORMATS)))
+
+    if format == 'msgpack' and msgpack is None:
+        raise RuntimeError('The msgpack package is required for the msgpack format, use jsonl.gz instead')
+
+def guess_format(filename, head=b''):
+    '''
+    Guess the format of a file from its extension, or else from its first
+    bytes. Anything unrecognized is treated as YAML. Content starting with
+    '{' is read as JSON Lines, which also reads a single JSON document.
+    '''
+    name = filename.lower()
+    for extension in sorted(FORMAT_EXTENSIONS, key=len, reverse=True):
+        if name.endswith(extension):
+            return FORMAT_EXTENSIONS[extension]
+
+    if head.startswith(GZIP_MAGIC):
+        return 'jsonl.gz'
+
+    if head.lstrip()[:1] == b'{':
+        return 'jsonl'
+
+    if head.lstrip()[:1] == b'[':
+        return 'json'
+
+    # msgpack map (fixmap, map 16, map 32)
+    if head and (0x80 <= head[0] <= 0x8f or head[0] in (0xde, 0xdf)):
+        return 'msgpack'
+
+    return 'yaml'
+
+def snapshot_document(hostname, modelNumber, serialNumber, configuration):
+    '''Build the snapshot document holding the configuration of one host'''
+    return OrderedDict([
+        ('hostname', hostname),
+        ('modelNumber', modelNumber),
+        ('serialNumber', serialNumber),
+        ('configuration', configuration),
+    ])
+
+def snapshot_key(document):
+    '''Return the (hostname, serialNumber) key of a snapshot document, or None for a plain configuration'''
+    if not isinstance(document, dict) or 'hostname' not in document or 'configuration' not in document:
+        return None
+
+    return (document['hostname'], document.get('serialNumber'))
+
+class SnapshotWriter(object):
+    '''
+    Write documents one at a time to a file in any of the FORMATS. A
+    snapshot document holds the configuration of one host, along with its
+    hostname, model number and serial number (see snapshot_key()).
+
+    YAML documents are separated with "---", JSON Lines are one document
+    per line, JSON is an array of the documents, one per line, and msgpack
+    documents are simply concatenated.
+    '''
+    def __init__(self, filename, format=None):
+        if format is None:
+            format = guess_format(filename)
 
-def read_input_file(filename):
-    # read from stdin if requested
+        check_format(format)
+
+        self.filename = filename
+        self.format = format
+        self.count = 0
+
+        if format == 'msgpack':
+            self.stream = open(filename, 'wb')
+            self.packer = msgpack.Packer(use_bin_type=True)
+        elif format == 'jsonl.gz':
+            self.stream = gzip.open(filename, 'wt', encoding='utf-8')
+        else:
+            self.stream = open(filename, 'w')
+
+    def write(self, document):
+        '''Append one document to the file'''
+        if self.format == 'yaml':
+            write_yaml_document(document, self.stream)
+        elif self.format == 'msgpack':
+            self.stream.write(self.packer.pack(document))
+        elif self.format == 'json':
+            self.stream.write('[\n' if self.count == 0 else ',\n')
+            self.stream.write(json.dumps(document, separators=(',', ':')))
+        else:
+            self.stream.write(json.dumps(document, separators=(',', ':')))
+            self.stream.write('\n')
+
+        self.count += 1
+
+    def close(self):
+        if self.format == 'json':
+            self.stream.write('[]\n' if self.count == 0 else '\n]\n')
+
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def write_snapshot(documents, filename, format=None):
+    '''Write each document of an iterable to a file, as it is produced'''
+    with SnapshotWriter(filename, format) as writer:
+        for document in documents:
+            writer.write(document)
+
+def _read_documents(stream, format):
+    '''Generate the documents of an open binary stream in the given format'''
+    if format == 'msgpack':
+        unpacker = msgpack.Unpacker(stream, raw=False, object_pairs_hook=OrderedDict)
+        for document in unpacker:
+            yield document
+
+        return
+
+    if format == 'jsonl.gz':
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+
+    if format == 'yaml':
+        for document in read_yaml_documents(stream):
+            yield document
+
+        return
+
+    # a single JSON document, or an array of documents, read as a whole
+    if format == 'json':
+        for document in _json_documents(stream.read()):
+            yield document
+
+        return
+
+    first = True
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            document = json.loads(line.decode('utf-8'), object_pairs_hook=OrderedDict)
+        except ValueError:
+            if not first:
+                raise
+
+            # not JSON Lines after all, but a JSON document spread over several lines
+            for document in _json_documents(line + stream.read()):
+                yield document
+
+            return
+
+        first = False
+        yield document
+
+def _json_documents(data):
+    '''Return the documents of the raw content of a JSON file: a single document, or an array of documents'''
+    data = json.loads(data.decode('utf-8'), object_pairs_hook=OrderedDict)
+    return data if isinstance(data, list) else [data, ]
+
+def read_snapshot(filename):
+    '''
+    Generate each document of a file (or stdin, for "-") one at a time. The
+    format is detected from the extension, or else from the first bytes.
+    '''
     if filename == '-':
-        return read_yaml(sys.stdin)
+        stream = sys.stdin.buffer
+        format = guess_format('', stream.peek(4)[:4])
+        check_format(format)
+        for document in _read_documents(stream, format):
+            yield document
+
+        return
+
+    with open(filename, 'rb') as f:
+        format = guess_format(filename, f.peek(4)[:4])
+        check_format(format)
+        for document in _read_documents(f, format):
+            yield document
+
+def read_input_file(filename, hostname=None):
+    '''
+    Read the configuration data from a file (or stdin, for "-") in any of
+    the FORMATS.
+
+    The file may hold a plain configuration, or snapshot documents. From a
+    snapshot, the configuration of the host with the given hostname or
+    serial number is returned. Without a hostname, the snapshot must hold
+    exactly one document.
+    '''
+    documents = read_snapshot(filename)
+    try:
+        first = next(documents, None)
+
+        # a plain configuration file
+        if snapshot_key(first) is None:
+            return first
+
+        if hostname is None:
+            if next(documents, None) is not None:
+                raise RuntimeError('Snapshot {} holds several hosts, the hostname is required'.format(filename))
+
+            return first['configuration']
+
+        wanted = hostname.lower()
+        for document in itertools.chain([first, ], documents):
+            keys = [str(key).lower() for key in snapshot_key(document) if key is not None]
+            if wanted in keys:
+                return document['configuration']
+    finally:
+        documents.close()
 
-    # otherwise read from the file specified
-    with open(filename, 'r') as f:
-        return read_yaml(f)
+    raise RuntimeError('No configuration for {} in snapshot {}'.format(hostname, filename))
 
 def main():
     pass
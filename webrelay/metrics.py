@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+'''
+Counters and latency histograms of the work done while talking to WebRelay
+devices: each phase of a run (credential detection, version detection,
+page loads, parsing, writes), each HTTP request by host and path, bytes
+received, retries and authentication failures.
+
+Instrumentation is disabled by default: the registry is a NullRegistry,
+whose methods do nothing. Enable it with set_registry(MetricsRegistry()),
+or with setup_metrics() from a command line tool, which also writes the
+metrics to a file as the tool exits.
+'''
+
+from __future__ import print_function
+
+from collections import OrderedDict
+
+import functools
+import threading
+import atexit
+import bisect
+import json
+import time
+import os
+
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+# Output formats of the metrics file
+METRICS_FORMATS = ('json', 'prometheus')
+
+class Histogram(object):
+    '''Latency histogram with fixed buckets, along with the count and sum of all observations'''
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulativeCounts(self):
+        '''Return the number of observations at or below each bucket bound'''
+        total = 0
+        counts = []
+        for count in self.counts:
+            total += count
+            counts.append(total)
+
+        return counts
+
+class Timer(object):
+    '''Context manager which observes the time spent inside it in a histogram of the registry'''
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, time.monotonic() - self.start, **self.labels)
+
+class NullTimer(object):
+    '''Context manager which does nothing'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NULL_TIMER = NullTimer()
+
+class NullRegistry(object):
+    '''
+    Registry used while instrumentation is disabled. Every method does
+    nothing, so instrumented code costs a method call and no more.
+    '''
+    enabled = False
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return NULL_TIMER
+
+class MetricsRegistry(object):
+    '''
+    In-process registry of counters and histograms, each identified by a
+    metric name and a set of labels. All methods are thread safe.
+    '''
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+
+        # (name, labels) -> value / Histogram, where labels is a sorted tuple of (key, value)
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+
+    def increment(self, name, value=1, **labels):
+        '''Add a value to a counter'''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        '''Record one observation (in seconds) in a histogram'''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        '''Return a context manager which observes the time spent inside it'''
+        return Timer(self, name, labels)
+
+    def toDict(self):
+        '''Build a nested dictionary of all metrics, for a JSON dump'''
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(key, histogram.cumulativeCounts(), histogram.count, histogram.sum)
+                          for key, histogram in self.histograms.items()]
+
+        data = OrderedDict()
+        data['counters'] = [OrderedDict([
+            ('name', name),
+            ('labels', OrderedDict(labels)),
+            ('value', value),
+        ]) for (name, labels), value in counters]
+
+        data['histograms'] = [OrderedDict([
+            ('name', name),
+            ('labels', OrderedDict(labels)),
+            ('count', count),
+            ('sum', total),
+            ('mean', total / count if count else 0.0),
+            ('buckets', OrderedDict((format_bound(bound), cumulative)
+                                    for bound, cumulative in zip(self.buckets, counts))),
+        ]) for (name, labels), counts, count, total in histograms]
+
+        return data
+
+    def toPrometheus(self):
+        '''Build the Prometheus text exposition format of all metrics'''
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(key, histogram.cumulativeCounts(), histogram.count, histogram.sum)
+                          for key, histogram in self.histograms.items()]
+
+        # the lines of each metric must be grouped together
+        counters.sort(key=lambda item: item[0][0])
+        histograms.sort(key=lambda item: item[0][0])
+
+        lines = []
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE {} counter'.format(name))
+
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+
+        for (name, labels), counts, count, total in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE {} histogram'.format(name))
+
+            for bound, cumulative in zip(self.buckets, counts):
+                bucketLabels = labels + (('le', format_bound(bound)), )
+                lines.append('{}_bucket{} {}'.format(name, format_labels(bucketLabels), cumulative))
+
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+
+        lines.append('')
+        return '\n'.join(lines)
+
+def format_bound(bound):
+    '''Format a bucket bound the way Prometheus does'''
+    if bound == float('inf'):
+        return '+Inf'
+
+    return repr(float(bound))
+
+def format_labels(labels):
+    '''Format a tuple of (key, value) labels the way Prometheus does'''
+    if not labels:
+        return ''
+
+    items = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        items.append('{}="{}"'.format(key, value))
+
+    return '{{{}}}'.format(','.join(items))
+
+# The registry used by all instrumented code
+_registry = NullRegistry()
+
+def get_registry():
+    '''Return the current registry (a NullRegistry while instrumentation is disabled)'''
+    return _registry
+
+def set_registry(registry):
+    '''Replace the current registry, returning the previous one. Use NullRegistry() to disable.'''
+    global _registry
+    previous = _registry
+    _registry = registry
+    return previous
+
+def timed(phase):
+    '''Decorator which observes the time spent in each call of a function as a phase of the run'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _registry.timer('webrelay_phase_seconds', phase=phase):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def write_metrics(registry, filename, format=None):
+    '''
+    Write all metrics of a registry to a file: in Prometheus text format for
+    the .prom and .txt extensions, otherwise as JSON.
+    '''
+    if format is None:
+        format = 'prometheus' if os.path.splitext(filename)[1] in ('.prom', '.txt') else 'json'
+
+    if format not in METRICS_FORMATS:
+        raise RuntimeError('Unknown metrics format {}, choose from: {}'.format(format, ', '.join(METRICS_FORMATS)))
+
+    if format == 'prometheus':
+        data = registry.toPrometheus()
+    else:
+        data = json.dumps(registry.toDict(), indent=4) + '\n'
+
+    with open(filename, 'w') as f:
+        f.write(data)
+
+def setup_metrics(filename, format=None):
+    '''
+    Enable instrumentation for the rest of a command line tool, and write
+    the metrics to a file as the tool exits (see write_metrics()).
+    '''
+    registry = MetricsRegistry()
+    set_registry(registry)
+    atexit.register(write_metrics, registry, filename, format)
+    return registry
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+'''
+Update plans: every HTTP request needed to write the changed settings of a
+WebRelay device, computed once, in the order they will be made.
+
+A plan can be saved to a file and replayed later (for example, the output
+of webrelay_diff given to webrelay_update) without fetching the pages of
+the device and comparing the settings again.
+'''
+
+from __future__ import print_function
+
+from collections import OrderedDict
+from collections import namedtuple
+
+import json
+import time
+import os
+
+# Structure to hold one HTTP request of an update plan
+PlannedWrite = namedtuple('PlannedWrite', [
+    'page',
+    'method',
+    'path',
+    'params',
+    'changes',
+    'newPassword',
+])
+
+# Structure to hold one setting which did not have the planned value after the update
+VerifyMismatch = namedtuple('VerifyMismatch', [
+    'page',
+    'setting',
+    'expected',
+    'actual',
+])
+
+class UpdatePlan(object):
+    '''
+    The HTTP requests needed to write the changed settings of one device.
+
+    Each write holds the name of the page, the HTTP method, path and query
+    parameters of the request, the changed settings (device and updated
+    values, in human-readable format), and the new password if the write
+    changes the password used to access the device. Writes which change the
+    password are always last, so that no other write needs the new password.
+
+    The saved plan contains the query parameters, including any new
+    passwords, so the file is only readable by the owner.
+    '''
+    def __init__(self, hostname, modelNumber, serialNumber, writes=None, created=None):
+        self.hostname = hostname
+        self.modelNumber = modelNumber
+        self.serialNumber = serialNumber
+        self.writes = writes if writes is not None else []
+        self.created = created if created is not None else time.time()
+
+    def needsUpdate(self):
+        '''Does this plan write anything to the device?'''
+        return len(self.writes) > 0
+
+    def estimateRequests(self):
+        '''Return the number of HTTP requests needed to carry out the plan'''
+        return len(self.writes)
+
+    def toDiffDict(self):
+        '''Build a nested dictionary of changed settings, by page'''
+        data = OrderedDict()
+        for write in self.writes:
+            data[write.page] = write.changes
+
+        return data
+
+    def printDiff(self):
+        '''Print a YAML-like unified diff of changed settings'''
+        for write in self.writes:
+            print('{}:'.format(write.page))
+            for name, change in write.changes.items():
+                print('- {}: {}'.format(name, change['device']))
+                print('+ {}: {}'.format(name, change['update']))
+
+    def toDict(self):
+        '''Build a nested dictionary representing this plan'''
+        data = OrderedDict()
+        data['hostname'] = self.hostname
+        data['modelNumber'] = self.modelNumber
+        data['serialNumber'] = self.serialNumber
+        data['created'] = self.created
+        data['writes'] = [write._asdict() for write in self.writes]
+        return data
+
+    @classmethod
+    def fromDict(cls, data):
+        '''Create a plan from a nested dictionary built by toDict()'''
+        try:
+            writes = [PlannedWrite(**write) for write in data['writes']]
+            return cls(data['hostname'], data['modelNumber'], data['serialNumber'], writes, data['created'])
+        except (KeyError, TypeError) as ex:
+            raise RuntimeError('Invalid update plan: {}'.format(str(ex)))
+
+    def save(self, filename):
+        '''Write the plan to a file, readable only by the owner'''
+        data = json.dumps(self.toDict(), indent=4)
+
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.write('\n')
+
+    @classmethod
+    def read(cls, filename):
+        '''Read a plan from a file written by save()'''
+        with open(filename, 'r') as f:
+            try:
+                data = json.load(f, object_pairs_hook=OrderedDict)
+            except ValueError as ex:
+                raise RuntimeError('Invalid update plan {}: {}'.format(filename, str(ex)))
+
+        return cls.fromDict(data)
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+'''
+Long-running poller of the relay and input state of many WebRelay devices.
+
+Each device is connected once (credential and model detection, see
+connect_webrelay_device()), and the device object is kept for the life of
+the poller, so that every poll is a single request for the state document.
+
+Polls are kept in a heap, ordered by the time they are due. Each device is
+polled at a fixed interval with random jitter, so that the polls of
+thousands of devices spread out instead of arriving in bursts, and at most
+max_workers polls run at the same time. A device which fails is polled again
+after an exponential backoff, and is detected again after it rejects its
+credentials.
+
+Only changes are reported (edge triggered): the first state of each device,
+any change of a relay or input, the first failure of a device, and the state
+of the device once it recovers.
+'''
+
+from __future__ import print_function
+
+from webrelay.utils import connect_webrelay_device
+
+from webrelay.session import WebRelay_Session
+from webrelay.metrics import get_registry
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from collections import namedtuple
+from collections import Counter
+
+import itertools
+import threading
+import requests
+import logging
+import random
+import heapq
+import queue
+import json
+import time
+
+# Kinds of events: first state (or state after a failure), changed state, failure
+EVENT_STATE = 'state'
+EVENT_CHANGE = 'change'
+EVENT_ERROR = 'error'
+
+# Structure to hold one event: the state of the relays and inputs (tuples of
+# booleans, None after a failure), and the numbers of the ones which changed
+StateEvent = namedtuple('StateEvent', [
+    'hostname',
+    'timestamp',
+    'kind',
+    'relays',
+    'inputs',
+    'changedRelays',
+    'changedInputs',
+    'error',
+])
+
+def changed_numbers(previous, current):
+    '''Return the numbers (starting at 1) of the relays or inputs which differ'''
+    return tuple(number for number, (old, new) in enumerate(zip(previous, current), 1) if old != new)
+
+def event_to_dict(event):
+    '''Build a dictionary of one event, for a JSON line. Relays and inputs are written as 0 / 1.'''
+    data = OrderedDict()
+    data['hostname'] = event.hostname
+    data['timestamp'] = event.timestamp
+    data['event'] = event.kind
+    if event.relays is not None:
+        data['relays'] = [int(value) for value in event.relays]
+        data['inputs'] = [int(value) for value in event.inputs]
+        data['changedRelays'] = list(event.changedRelays)
+        data['changedInputs'] = list(event.changedInputs)
+
+    if event.error is not None:
+        data['error'] = event.error
+
+    return data
+
+class NDJSONWriter(object):
+    '''Event callback which writes each event as one JSON line to a stream, flushed right away'''
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __call__(self, event):
+        self.stream.write(json.dumps(event_to_dict(event)))
+        self.stream.write('\n')
+        self.stream.flush()
+
+class PolledDevice(object):
+    '''Polling state of one host: the connected device, and what was last reported'''
+    __slots__ = ('hostname', 'device', 'due', 'failures', 'state', 'failed')
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        # connected device, or None until detection succeeds
+        self.device = None
+        # time.monotonic() at which the next poll is due
+        self.due = 0.0
+        # number of consecutive failed polls
+        self.failures = 0
+        # last RelayState reported
+        self.state = None
+        # has the current failure been reported?
+        self.failed = False
+
+class Poller(object):
+    '''
+    Poll the state of many WebRelay devices, and call the callback with a
+    StateEvent for every change. The callback is always called from the
+    thread running run(), one event at a time, so it needs no locking: for
+    example, NDJSONWriter(sys.stdout), or the put() method of a queue.
+
+    All devices share one HTTP session, which keeps the connection to each
+    device open between polls where the firmware allows it. With a
+    DeviceCache, hosts found in the cache skip detection. Whenever hosts are
+    detected or forgotten, the cache is saved, at most once every
+    save_interval seconds, so that a poller which is killed loses little;
+    the caller is responsible for saving the cache once more afterwards.
+    '''
+    def __init__(self, hostnames, callback, username=None, password=None, password_file=None, interval=5.0,
+                 jitter=0.1, max_workers=16, max_backoff=300.0, session=None, cache=None, save_interval=60.0):
+        if interval <= 0:
+            raise RuntimeError('Poll interval must be positive')
+
+        if not 0 <= jitter < 1:
+            raise RuntimeError('Poll jitter must be at least 0 and less than 1')
+
+        if max_workers < 1:
+            raise RuntimeError('Global concurrency limit must be at least 1')
+
+        self.callback = callback
+        self.auth = (username, password, password_file)
+        self.interval = interval
+        self.jitter = jitter
+        self.maxWorkers = max_workers
+        self.maxBackoff = max_backoff
+        self.cache = cache
+        self.saveInterval = save_interval
+
+        # has the cache changed since it was last saved, and when was that (time.monotonic(), None if never)
+        self.cacheChanged = False
+        self.cacheSaved = None
+
+        if session is None:
+            session = WebRelay_Session(pool_size=1, pool_hosts=max(1, len(hostnames)), retries=0)
+
+        self.session = session
+        self.random = random.Random()
+        self.running = threading.Event()
+
+        # hostname -> PolledDevice
+        self.devices = OrderedDict((hostname, PolledDevice(hostname)) for hostname in hostnames)
+
+        # polls by due time: heap of (due, sequence, hostname)
+        self.heap = []
+        self.sequence = itertools.count()
+
+        # finished polls, filled by the worker threads
+        self.results = queue.Queue()
+        self.inflight = 0
+
+        # number of polls, failures and events of each kind
+        self.stats = Counter()
+
+    def jittered(self, seconds):
+        '''Spread a delay randomly by the jitter fraction'''
+        return seconds * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def getBackoff(self, failures):
+        '''Return the delay before the next poll after a number of consecutive failures'''
+        return self.jittered(min(self.maxBackoff, self.interval * 2 ** failures))
+
+    def schedule(self, polled, delay):
+        '''Schedule the next poll of a host after a delay, in seconds'''
+        polled.due = time.monotonic() + delay
+        heapq.heappush(self.heap, (polled.due, next(self.sequence), polled.hostname))
+
+    def poll(self, hostname, device):
+        '''
+        Poll one host, connecting to it first if there is no device yet. Runs
+        in a worker thread, and only returns (hostname, device, RelayState,
+        error, forget), where forget means the device must be detected again.
+        '''
+        username, password, password_file = self.auth
+        try:
+            if device is None:
+                try:
+                    device = connect_webrelay_device(hostname, username, password, password_file, self.session,
+                                                     1, self.cache)
+                finally:
+                    # no pages are ever loaded, so the responses remembered during detection are not needed
+                    self.session.forget(hostname)
+
+                if device is None:
+                    return (hostname, None, None, 'unable to connect and authenticate', True)
+
+            return (hostname, device, device.readState(), None, False)
+        except requests.exceptions.HTTPError as ex:
+            # the credentials may have been changed: detect them again
+            forget = ex.response is not None and ex.response.status_code == 401
+            return (hostname, device, None, str(ex), forget)
+        except RuntimeError as ex:
+            # the state document does not match the model: detect it again
+            return (hostname, device, None, str(ex), True)
+        except Exception as ex:
+            return (hostname, device, None, str(ex), False)
+
+    def runPoll(self, hostname, device):
+        self.results.put(self.poll(hostname, device))
+
+    def handleResult(self, result):
+        '''Record the result of one poll, report any change, and schedule the next poll'''
+        hostname, device, state, error, forget = result
+        polled = self.devices[hostname]
+        metrics = get_registry()
+        self.inflight -= 1
+        self.stats['polls'] += 1
+
+        if error is not None:
+            logging.debug('Poll of %s failed: %s', hostname, error)
+            metrics.increment('webrelay_polls_total', result='error')
+            self.stats['failures'] += 1
+
+            polled.failures += 1
+            polled.device = None if forget else device
+            if forget and self.cache is not None:
+                self.cache.invalidate(hostname)
+                self.cacheChanged = True
+
+            if not polled.failed:
+                polled.failed = True
+                self.emit(StateEvent(hostname, time.time(), EVENT_ERROR, None, None, (), (), error))
+
+            self.schedule(polled, self.getBackoff(polled.failures))
+            return
+
+        metrics.increment('webrelay_polls_total', result='ok')
+        previous = polled.state
+        if polled.device is None and self.cache is not None:
+            # the host was just detected (or found in the cache)
+            self.cacheChanged = True
+
+        polled.device = device
+        polled.failures = 0
+        polled.state = state
+
+        if previous is None or polled.failed:
+            polled.failed = False
+            self.emit(StateEvent(hostname, state.timestamp, EVENT_STATE, state.relays, state.inputs, (), (), None))
+        else:
+            changedRelays = changed_numbers(previous.relays, state.relays)
+            changedInputs = changed_numbers(previous.inputs, state.inputs)
+            if changedRelays or changedInputs:
+                self.emit(StateEvent(hostname, state.timestamp, EVENT_CHANGE, state.relays, state.inputs,
+                                     changedRelays, changedInputs, None))
+
+        self.schedule(polled, self.jittered(self.interval))
+
+    def saveCache(self):
+        '''Save the cache if it changed, and it was not saved in the last save_interval seconds'''
+        if self.cache is None or not self.cacheChanged:
+            return
+
+        now = time.monotonic()
+        if self.cacheSaved is not None and now - self.cacheSaved < self.saveInterval:
+            return
+
+        try:
+            self.cache.save()
+        except OSError as ex:
+            logging.warning('Unable to save the device cache: %s', ex)
+
+        self.cacheChanged = False
+        self.cacheSaved = now
+
+    def emit(self, event):
+        '''Report one event to the callback'''
+        get_registry().increment('webrelay_poll_events_total', kind=event.kind)
+        self.stats[event.kind] += 1
+        self.callback(event)
+
+    def run(self, duration=None):
+        '''
+        Poll until stop() is called, or for the given number of seconds. The
+        first poll of each host is spread randomly over one interval.
+        '''
+        deadline = time.monotonic() + duration if duration is not None else None
+        metrics = get_registry()
+
+        self.running.set()
+        self.heap = []
+        self.results = queue.Queue()
+        self.inflight = 0
+        for polled in self.devices.values():
+            self.schedule(polled, self.random.uniform(0, self.interval))
+
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            try:
+                while self.running.is_set():
+                    now = time.monotonic()
+                    if deadline is not None and now >= deadline:
+                        break
+
+                    # start every poll which is due, as long as a worker is free
+                    while self.heap and self.heap[0][0] <= now and self.inflight < self.maxWorkers:
+                        due, sequence, hostname = heapq.heappop(self.heap)
+                        metrics.observe('webrelay_poll_lag_seconds', now - due)
+                        self.inflight += 1
+                        executor.submit(self.runPoll, hostname, self.devices[hostname].device)
+
+                    # wait for a result, or until the next poll is due (waking up to check for stop())
+                    timeout = 1.0
+                    if self.heap and self.inflight < self.maxWorkers:
+                        timeout = min(timeout, self.heap[0][0] - now)
+
+                    if deadline is not None:
+                        timeout = min(timeout, deadline - now)
+
+                    try:
+                        self.handleResult(self.results.get(timeout=max(0.0, timeout)))
+                        while True:
+                            self.handleResult(self.results.get_nowait())
+                    except queue.Empty:
+                        pass
+
+                    self.saveCache()
+            finally:
+                self.running.clear()
+
+    def stop(self):
+        '''Stop polling, from any thread. The polls already running are finished first.'''
+        self.running.clear()
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+'''
+Profiling of a whole run of a command line tool, see setup_profiling().
+
+Three profiles are recorded at the same time:
+- cProfile: exact call counts and times of every function (main thread)
+- a sampling profiler: the stack of every thread, every few milliseconds,
+  written as collapsed stacks for flamegraph tools
+- tracemalloc: the lines of code holding the most memory at the end
+
+Each stack sample is also classified by its innermost frame as network wait
+(blocked in the socket and HTTP client stack), idle (a thread waiting for
+work or events, or a server thread such as those of the simulator) or CPU
+(everything else, such as parsing, converting settings and serializing),
+which separates the time spent waiting for the slow devices from the time
+spent in this package.
+'''
+
+from __future__ import print_function
+
+from collections import Counter
+
+import threading
+import tracemalloc
+import cProfile
+import atexit
+import pstats
+import time
+import sys
+import io
+import os
+
+# Sampling interval of the stack sampler, in seconds
+DEFAULT_INTERVAL = 0.005
+
+# Kinds of stack samples
+SAMPLE_NETWORK = 'network'
+SAMPLE_IDLE = 'idle'
+SAMPLE_CPU = 'cpu'
+
+# Paths of the modules which block on the network (the socket and HTTP client stack), with '/' separators
+NETWORK_PATHS = ('/socket.py', '/ssl.py', '/http/client.py', '/urllib3/')
+
+# Functions (file name, function) which wait for other threads or for events
+IDLE_FUNCTIONS = (
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('selectors.py', 'select'),
+    # a ThreadPoolExecutor worker waiting for a task
+    ('thread.py', '_worker'),
+)
+
+# Modules of servers, whose threads are not part of the client being profiled
+SERVER_MODULES = ('socketserver.py', )
+
+def frame_name(path, function):
+    '''Name a stack frame for a collapsed stack: file name and function'''
+    return '{}:{}'.format(os.path.basename(path), function)
+
+def classify_stack(frames):
+    '''
+    Classify a stack, given as (path, function) of each frame (outermost
+    first), as network wait, idle or CPU, from its innermost frame
+    '''
+    if any(os.path.basename(path) in SERVER_MODULES for path, function in frames):
+        return SAMPLE_IDLE
+
+    path, function = frames[-1]
+    path = path.replace(os.sep, '/')
+    if any(fragment in path for fragment in NETWORK_PATHS):
+        return SAMPLE_NETWORK
+
+    if (os.path.basename(path), function) in IDLE_FUNCTIONS:
+        return SAMPLE_IDLE
+
+    return SAMPLE_CPU
+
+class StackSampler(threading.Thread):
+    '''
+    Sample the stacks of all other threads at a fixed interval. The samples
+    are counted as collapsed stacks: the thread name and each frame, from
+    the outermost, separated by semicolons.
+    '''
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        super().__init__(name='StackSampler', daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.kinds = Counter()
+        self.running = threading.Event()
+
+    def run(self):
+        self.running.set()
+        names = {}
+        while self.running.is_set():
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+
+                frames = []
+                while frame is not None:
+                    frames.append((frame.f_code.co_filename, frame.f_code.co_name))
+                    frame = frame.f_back
+
+                frames.reverse()
+                self.kinds[classify_stack(frames)] += 1
+
+                stack = [frame_name(path, function) for path, function in frames]
+                stack.insert(0, names.get(ident, 'thread-{}'.format(ident)).replace(';', '_'))
+                self.stacks[';'.join(stack)] += 1
+
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running.clear()
+        self.join()
+
+    def writeFolded(self, filename):
+        '''Write the collapsed stacks, one "stack count" line each (for flamegraph.pl, speedscope, ...)'''
+        with open(filename, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('{} {}\n'.format(stack, count))
+
+class Profiler(object):
+    '''
+    Profile a run with cProfile, the StackSampler and tracemalloc, and write
+    the results to files named after a prefix:
+    - PREFIX.pstats: cProfile statistics (pstats, snakeviz, gprof2dot)
+    - PREFIX.folded: collapsed stacks of all threads (flamegraph tools)
+    - PREFIX.txt: summary of wall and CPU time, network wait, the functions
+      with the most cumulative time and the largest memory allocations
+    '''
+    def __init__(self, prefix, interval=DEFAULT_INTERVAL):
+        self.prefix = prefix
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(interval)
+        self.startWall = None
+        self.startCpu = None
+        self.stopped = False
+
+    def start(self):
+        tracemalloc.start(10)
+        self.sampler.start()
+        self.startWall = time.monotonic()
+        self.startCpu = time.process_time()
+        self.profile.enable()
+
+    def stop(self):
+        '''Stop profiling, and write all of the results'''
+        if self.stopped:
+            return
+
+        self.stopped = True
+        self.profile.disable()
+        wall = time.monotonic() - self.startWall
+        cpu = time.process_time() - self.startCpu
+        self.sampler.stop()
+
+        # leave out the memory used by the profilers themselves
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.profile.dump_stats('{}.pstats'.format(self.prefix))
+        self.sampler.writeFolded('{}.folded'.format(self.prefix))
+
+        with open('{}.txt'.format(self.prefix), 'w') as f:
+            f.write(self.summarize(wall, cpu, snapshot, peak))
+
+    def summarize(self, wall, cpu, snapshot, peak):
+        '''Build the text summary of the profile'''
+        lines = []
+        lines.append('Wall time: {:.3f} s'.format(wall))
+        lines.append('Process CPU time: {:.3f} s'.format(cpu))
+
+        total = sum(self.sampler.kinds.values())
+        lines.append('Stack samples: {} (every {} ms, all threads)'.format(total, self.sampler.interval * 1000))
+        for kind in (SAMPLE_NETWORK, SAMPLE_CPU, SAMPLE_IDLE):
+            share = self.sampler.kinds[kind] / total if total else 0.0
+            lines.append('  {:8s} {:6.1%}'.format(kind, share))
+
+        lines.append('Peak traced memory: {:.1f} KiB'.format(peak / 1024))
+        lines.append('')
+
+        lines.append('Largest memory allocations (still held at the end of the run):')
+        for stat in snapshot.statistics('lineno')[:15]:
+            lines.append('  {}'.format(stat))
+
+        lines.append('')
+        lines.append('Functions with the most cumulative time (main thread):')
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(25)
+        lines.append(stream.getvalue())
+
+        return '\n'.join(lines)
+
+def setup_profiling(prefix, interval=DEFAULT_INTERVAL):
+    '''
+    Profile the rest of a command line tool, and write the results as the
+    tool exits (see Profiler).
+    '''
+    profiler = Profiler(prefix, interval)
+    profiler.start()
+    atexit.register(profiler.stop)
+    return profiler
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
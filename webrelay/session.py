@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from webrelay.metrics import get_registry
+
+import threading
+import requests
+import hashlib
+import logging
+import hmac
+import time
+import os
+
+# Random key of the password hashes in log messages, new for every run
+MASK_KEY = os.urandom(16)
+
+class MaskedPassword(object):
+    '''
+    A password in a log message, shown only as a short hash of the password,
+    so that different passwords can be told apart without revealing them.
+    The hash is keyed with MASK_KEY, so it cannot be checked against a list
+    of likely passwords (such as a password file) from the log alone. It is
+    only computed if the message is actually logged.
+    '''
+    __slots__ = ('password', )
+
+    def __init__(self, password):
+        self.password = password
+
+    def __str__(self):
+        if self.password is None:
+            return 'None'
+
+        digest = hmac.new(MASK_KEY, self.password.encode('utf-8'), hashlib.sha256).hexdigest()
+        return 'hmac:{}'.format(digest[:8])
+
+    __repr__ = __str__
+
+def masked(password):
+    '''Wrap a password for a log message (see MaskedPassword)'''
+    return MaskedPassword(password)
+
+class WriteSafeRetry(Retry):
+    '''
+    Retry policy which never sends a request with parameters (a query
+    string) twice: such a request is only retried when the connection could
+    not be made, since after a read error or timeout it may already have
+    changed the device. Requests without parameters are retried as usual.
+    '''
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if error is not None and url is not None and '?' in url and not self._is_connection_error(error):
+            raise error.with_traceback(_stacktrace)
+
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+class WebRelay_Session(object):
+    '''
+    Pooled HTTP session used for all communication with WebRelay devices.
+
+    The embedded web server is slow to accept new connections, so HTTP
+    keep-alive is used wherever possible. Some firmware versions drop
+    persistent connections without warning: when a request on a host which
+    has already answered fails to connect, it is retried once with keep-alive
+    disabled, and that host is never sent keep-alive requests again.
+
+    Requests with parameters (configuration writes and relay commands) change
+    the device, so they are never sent twice: they share the connection pool
+    of all other requests, but are only retried when the connection could not
+    be made, never after a read error or timeout (see WriteSafeRetry), and
+    never resent without keep-alive.
+
+    Successful responses fetched with remember=True (for example, while testing
+    credentials) are kept until they are handed out once by fetch(), to avoid
+    fetching the same page twice, or until forget() is called for the host
+    (after the first load of a device). Any request with parameters changes
+    the device, so it forgets all remembered responses for that host.
+    '''
+    def __init__(self, pool_size=4, pool_hosts=10, retries=2, backoff=0.5, timeout=10, keepalive=True):
+        self.timeout = timeout
+        self.keepalive = keepalive
+
+        # hosts which have answered at least once, and hosts which cannot keep-alive
+        self.lock = threading.Lock()
+        self.seenHosts = set()
+        self.closeHosts = set()
+
+        # remembered responses, by (hostname, path, username, password)
+        self.responses = {}
+
+        retry = WriteSafeRetry(total=retries, connect=retries, read=retries, status=0, backoff_factor=backoff)
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+
+    def close(self):
+        '''Close all pooled connections'''
+        self.session.close()
+
+    def getHeaders(self, hostname):
+        '''Return the extra HTTP headers to send to this host'''
+        if not self.keepalive or hostname in self.closeHosts:
+            return {'Connection': 'close', }
+
+        return {}
+
+    def forget(self, hostname=None):
+        '''Forget the remembered responses of one host, or of all hosts'''
+        with self.lock:
+            if hostname is None:
+                self.responses.clear()
+                return
+
+            for key in [key for key in self.responses if key[0] == hostname]:
+                del self.responses[key]
+
+    def fetch(self, hostname, path, username, password):
+        '''
+        Perform an HTTP GET request for a page without parameters, using the
+        remembered response instead of the network if there is one.
+        '''
+        key = (hostname, path, username, password)
+        with self.lock:
+            response = self.responses.pop(key, None)
+
+        if response is not None:
+            logging.debug('Using remembered response for %s%s', hostname, path)
+            return response
+
+        return self.get(hostname, path, username, password)
+
+    def get(self, hostname, path, username, password, params=None, stream=False, remember=False):
+        '''
+        Perform an HTTP GET request against a WebRelay device, returning the
+        requests.Response object.
+
+        With remember=True, a successful response is kept for a later fetch()
+        of the same page.
+        '''
+        # any request with parameters may change the pages of the device
+        if params is not None:
+            self.forget(hostname)
+
+        url = 'http://{}{}'.format(hostname, path)
+        auth = (username, password)
+        headers = self.getHeaders(hostname)
+
+        metrics = get_registry()
+        start = time.monotonic()
+        retries = 0
+
+        try:
+            try:
+                response = self.session.get(url, auth=auth, params=params, headers=headers,
+                                            timeout=self.timeout, stream=stream)
+            except requests.exceptions.ConnectionError:
+                # only fall back when the host is known to be up, and it was using keep-alive
+                with self.lock:
+                    fallback = hostname in self.seenHosts and hostname not in self.closeHosts
+                    if fallback and self.keepalive:
+                        self.closeHosts.add(hostname)
+                    else:
+                        raise
+
+                # the request may already have changed the device
+                if params is not None:
+                    raise
+
+                logging.debug('Connection to %s failed, retrying without keep-alive', hostname)
+                retries += 1
+                headers = self.getHeaders(hostname)
+                response = self.session.get(url, auth=auth, params=params, headers=headers,
+                                            timeout=self.timeout, stream=stream)
+        except requests.exceptions.RequestException:
+            metrics.increment('webrelay_request_errors_total', host=hostname)
+            raise
+
+        if metrics.enabled:
+            # retries made by urllib3 within the request
+            history = getattr(getattr(response.raw, 'retries', None), 'history', None)
+            retries += len(history) if history else 0
+            received = None if stream else len(response.content)
+            record_response(metrics, hostname, path, response.status_code, received, retries,
+                            time.monotonic() - start)
+
+        with self.lock:
+            self.seenHosts.add(hostname)
+            if remember and not stream and response.status_code == 200:
+                self.responses[(hostname, path, username, password)] = response
+
+        return response
+
+def record_response(metrics, hostname, path, status, received, retries, seconds):
+    '''Record the metrics of one HTTP response: latency, status, bytes received, retries and auth failures'''
+    metrics.observe('webrelay_request_seconds', seconds, host=hostname, path=path)
+    metrics.increment('webrelay_requests_total', host=hostname, status=status)
+
+    if received is not None:
+        metrics.increment('webrelay_received_bytes_total', received, host=hostname)
+
+    if retries:
+        metrics.increment('webrelay_retries_total', retries, host=hostname)
+
+    if status == 401:
+        metrics.increment('webrelay_auth_failures_total', host=hostname)
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
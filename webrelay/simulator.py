@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+
+'''
+Local HTTP simulator of WebRelay devices, for benchmarks and testing
+without real hardware.
+
+Each simulated device serves the configuration pages of its model (built
+from the same page models used to configure real devices), the version
+information page, the state document of its relays and inputs (which also
+takes relay commands), and the GET-based .srv update requests, all behind
+HTTP basic authentication. The
+latency, jitter and connection limit of the slow embedded web server can be
+configured.
+'''
+
+from __future__ import print_function
+
+from webrelay.device import WebRelay1
+from webrelay.device import WebRelay4
+from webrelay.device import WebRelay6
+from webrelay.device import WebRelay10
+
+from webrelay.device.settings import Setting_IP
+from webrelay.device.settings import Setting_Checkbox
+from webrelay.device.settings import Setting_Select
+from webrelay.device.settings import Setting_Password
+from webrelay.device.settings import Setting_Radio
+from webrelay.device.settings import PASSWORD_PLACEHOLDER
+
+from webrelay.device.state import STATE_PATH
+from webrelay.device.state import RELAY_ACTIONS
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl
+from urllib.parse import urlsplit
+from collections import OrderedDict
+from collections import namedtuple
+from collections import Counter
+
+import threading
+import binascii
+import socket
+import logging
+import random
+import html
+import time
+
+# Structure to describe one simulated model
+SimulatorModel = namedtuple('SimulatorModel', [
+    'deviceClass',
+    'modelNumber',
+    'firmwareVersion',
+    'versionPath',
+])
+
+# Simulated models, by the short name used on the command line
+SIMULATOR_MODELS = OrderedDict([
+    ('1', SimulatorModel(WebRelay1, 'X-WR-1R12-1I24-I', '3.02', '/about.html')),
+    ('4', SimulatorModel(WebRelay4, 'X-WR-4R12-I', '2.11', '/about.html')),
+    ('6', SimulatorModel(WebRelay6, 'X-WR-6R12-I', '1.16', '/home.html')),
+    ('10', SimulatorModel(WebRelay10, 'X-WR-10R12-I', '1.16', '/home.html')),
+])
+
+# Pages which may hold the version information on some model
+VERSION_PATHS = ('/about.html', '/home.html')
+
+# Options of the <select> elements: list of (value, text)
+SELECT_OPTIONS = {
+    'relayOption': [('0', 'Set relay (on/off)'), ('1', 'Set relay with input'), ('2', 'Set relay with remote')],
+    'rmtRelayOption': [('0', 'Disabled'), ('1', 'Send state'), ('2', 'Send inverted state')],
+    'pingRmt': [('0', 'No'), ('1', 'Yes')],
+    'rlyPwrState': [('0', 'Off'), ('1', 'On'), ('2', 'Last State')],
+    'rlyEmailOpt': [('0', 'No Email'), ('1', 'Relay On'), ('2', 'Relay Off'), ('3', 'Relay On/Off')],
+}
+
+# Default values of the settings, by form name
+DEFAULT_VALUES = {
+    'ip1': '192', 'ip2': '168', 'ip3': '1', 'ip4': '2',
+    'nm1': '255', 'nm2': '255', 'nm3': '255', 'nm4': '0',
+    'bc1': '192', 'bc2': '168', 'bc3': '1', 'bc4': '255',
+    'gw1': '192', 'gw2': '168', 'gw3': '1', 'gw4': '1',
+    'lP': '80', 'lport': '80', 'mbusport': '502', 'mP': '502', 'msp': '25',
+    'snmpP': '161', 'sTP': '162', 'rport': '80', 'relayNumber': '1',
+    'pulseDur': '1.5', 'pulseTime': '1.5', 'refreshDur': '10', 'refreshRate': '10',
+}
+
+# Maximum length of each text input
+TEXT_MAXLENGTH = 40
+
+# Seconds a relay stays on after a pulse command
+PULSE_DURATION = 1.5
+
+def default_values(setting, password):
+    '''Return the {formName: value} defaults of one setting of a factory fresh device'''
+    if isinstance(setting, Setting_IP):
+        return {name: DEFAULT_VALUES.get(name, '0') for name in setting.formName}
+
+    if isinstance(setting, Setting_Checkbox):
+        return {setting.formName: False, }
+
+    if isinstance(setting, Setting_Select):
+        options = SELECT_OPTIONS.get(setting.formName, [('0', 'No'), ('1', 'Yes')])
+        return {setting.formName: options[0][0], }
+
+    if isinstance(setting, Setting_Password):
+        value = password if setting.password is not None else ''
+        return {setting.formName: value, }
+
+    if isinstance(setting, Setting_Radio):
+        return {setting.formName: sorted(setting.deviceMap.values())[0], }
+
+    return {setting.formName: DEFAULT_VALUES.get(setting.formName, ''), }
+
+def render_setting(setting, values):
+    '''Render the table row with the form controls of one setting'''
+    name = setting.formName
+    escape = html.escape
+
+    if isinstance(setting, Setting_IP):
+        controls = ['<input type="text" name="{}" size="3" maxlength="3" value="{}">'.format(part, values[part])
+                    for part in name]
+        controls = ' . '.join(controls)
+    elif isinstance(setting, Setting_Checkbox):
+        checked = ' checked' if values[name] else ''
+        controls = '<input type="checkbox" name="{}"{}>'.format(name, checked)
+    elif isinstance(setting, Setting_Select):
+        options = []
+        for value, text in SELECT_OPTIONS.get(name, [('0', 'No'), ('1', 'Yes')]):
+            selected = ' selected' if value == values[name] else ''
+            # like the real firmware, the options are never closed
+            options.append('<option value="{}"{}>{}'.format(value, selected, escape(text)))
+
+        controls = '<select name="{}">{}</select>'.format(name, ''.join(options))
+    elif isinstance(setting, Setting_Password):
+        controls = '<input type="password" name="{}" maxlength="10" value="{}">'.format(name, PASSWORD_PLACEHOLDER)
+    elif isinstance(setting, Setting_Radio):
+        controls = []
+        for human, value in sorted(setting.deviceMap.items()):
+            checked = ' checked' if value == values[name] else ''
+            controls.append('<input type="radio" name="{}" value="{}"{}>{}'.format(name, value, checked,
+                                                                                 escape(human)))
+
+        controls = ' '.join(controls)
+    else:
+        controls = '<input type="text" name="{}" maxlength="{}" value="{}">'.format(name, TEXT_MAXLENGTH,
+                                                                                   escape(values[name]))
+
+    return '<tr>\n<td>{}:</td>\n<td>{}</td>\n</tr>'.format(escape(setting.name), controls)
+
+class Simulated_WebRelay(object):
+    '''
+    State of one simulated WebRelay device: the values of all settings on all
+    of its configuration pages, and the password used to access them.
+    '''
+    def __init__(self, model, serialNumber, username='admin', password='webrelay'):
+        self.model = SIMULATOR_MODELS[model]
+        self.serialNumber = serialNumber
+        self.username = username
+        self.password = password
+        self.lock = threading.Lock()
+
+        # path -> list of settings shown on that page
+        self.pages = OrderedDict()
+        # path -> {formName: value}
+        self.values = {}
+        # list of (updatePath, query parameters, path)
+        self.updates = []
+        # names of the checkbox settings
+        self.checkboxes = set()
+        # number of update requests applied
+        self.writes = 0
+
+        # live state of the relays and inputs
+        self.stateLayout = self.model.deviceClass.stateLayout
+        self.relays = [False] * len(self.stateLayout.relays)
+        self.inputs = [False] * len(self.stateLayout.inputs)
+        # time.monotonic() at which each pulsed relay turns off again
+        self.pulses = [0.0] * len(self.relays)
+        # number of relay command requests applied
+        self.commands = 0
+
+        device = self.model.deviceClass('simulator', username, password)
+        for page in device.pages:
+            path = page.getPath()
+            self.pages.setdefault(path, []).extend(page.settings)
+
+            values = self.values.setdefault(path, {})
+            for setting in page.settings:
+                values.update(default_values(setting, password))
+                if isinstance(setting, Setting_Checkbox):
+                    self.checkboxes.add(setting.formName)
+
+            update = (page.getUpdatePath(), dict(parse_qsl(urlsplit(path).query)), path)
+            if update not in self.updates:
+                self.updates.append(update)
+
+    def checkAuthorization(self, header):
+        '''Check the value of the HTTP Authorization header'''
+        if header is None or not header.startswith('Basic '):
+            return False
+
+        try:
+            userpass = binascii.a2b_base64(header[6:].strip()).decode('latin-1')
+        except (binascii.Error, ValueError):
+            return False
+
+        with self.lock:
+            return userpass == '{}:{}'.format(self.username, self.password)
+
+    def renderPage(self, path):
+        '''Render the HTML form of one configuration page'''
+        updatePath = [update[0] for update in self.updates if update[2] == path][0]
+
+        with self.lock:
+            rows = [render_setting(setting, self.values[path]) for setting in self.pages[path]]
+
+        lines = [
+            '<html>',
+            '<head><title>{} Setup</title></head>'.format(self.model.modelNumber),
+            '<body>',
+            '<form action="{}" method="get">'.format(updatePath),
+            '<table>',
+        ]
+        lines.extend(rows)
+        lines.extend([
+            '</table>',
+            '<input type="submit" value="Submit">',
+            '</form>',
+            '</body>',
+            '</html>',
+        ])
+
+        return '\n'.join(lines).encode('utf-8')
+
+    def renderVersion(self):
+        '''Render the version information page, in the layout of this model'''
+        model = self.model
+        if model.versionPath == '/about.html':
+            # WebRelay1 and WebRelay4: <p> elements within a single table row
+            lines = [
+                '<html><body><table><tr><td>',
+                '<p>Model: {}</p>'.format(model.modelNumber),
+                '<p>Product Revision: {}</p>'.format(model.firmwareVersion),
+                '<p>Serial Number: {}</p>'.format(self.serialNumber),
+                '</td></tr></table></body></html>',
+            ]
+        else:
+            # WebRelay6 and WebRelay10: one table row for each datum
+            lines = [
+                '<html><body><table>',
+                '<tr><td>Part Number:</td>\n<td>{}</td></tr>'.format(model.modelNumber),
+                '<tr><td>Firmware Revision:</td>\n<td>{}</td></tr>'.format(model.firmwareVersion),
+                '<tr><td>Serial Number:</td>\n<td>{}</td></tr>'.format(self.serialNumber),
+                '</table></body></html>',
+            ]
+
+        return '\n'.join(lines).encode('utf-8')
+
+    def renderState(self):
+        '''Render the state document of the relays and inputs'''
+        layout = self.stateLayout
+        now = time.monotonic()
+        with self.lock:
+            relays = [value or now < pulse for value, pulse in zip(self.relays, self.pulses)]
+            values = relays + self.inputs
+
+        lines = ['<?xml version="1.0" encoding="utf-8"?>', '<datavalues>']
+        for tag, value in zip(layout.relays + layout.inputs, values):
+            lines.append('<{0}>{1}</{0}>'.format(tag, 1 if value else 0))
+
+        lines.append('</datavalues>')
+        return '\n'.join(lines).encode('utf-8')
+
+    def command(self, params):
+        '''
+        Apply the relay commands in the query parameters of a state document
+        request. Return False if any command is invalid, or there are more
+        than the batch size of the model.
+        '''
+        layout = self.stateLayout
+        values = {value: action for action, value in RELAY_ACTIONS.items()}
+        if len(params) > layout.batchSize:
+            return False
+
+        if any(key not in layout.commands or value not in values for key, value in params.items()):
+            return False
+
+        now = time.monotonic()
+        with self.lock:
+            self.commands += 1
+            for key, value in params.items():
+                index = layout.commands.index(key)
+                action = values[value]
+                if action == 'pulse':
+                    self.relays[index] = False
+                    self.pulses[index] = now + PULSE_DURATION
+                else:
+                    self.relays[index] = action == 'on'
+                    self.pulses[index] = 0.0
+
+        return True
+
+    def update(self, updatePath, params):
+        '''
+        Apply the parameters of a .srv update request. Return False if no
+        page is updated through this path.
+        '''
+        paths = []
+        for path, query, readPath in self.updates:
+            if path != updatePath:
+                continue
+
+            if all(params.get(key) == value for key, value in query.items()):
+                paths.append(readPath)
+
+        if not paths:
+            return False
+
+        with self.lock:
+            self.writes += 1
+            for path in paths:
+                values = self.values[path]
+                for key, value in params.items():
+                    if key not in values:
+                        continue
+
+                    if key in self.checkboxes:
+                        value = value.lower() in ('true', 'on', '1', 'yes')
+
+                    values[key] = value
+                    if key == 'setupPswd':
+                        self.password = value
+
+        return True
+
+    def handle(self, target):
+        '''Handle a GET request for the target (path and query), returning (status, content)'''
+        url = urlsplit(target)
+        path = url.path
+
+        # configuration pages, some of which include the query in the path
+        if target in self.pages:
+            return (200, self.renderPage(target))
+
+        if path in self.pages and not url.query:
+            return (200, self.renderPage(path))
+
+        # live state of the relays and inputs, after any relay commands
+        if path == STATE_PATH:
+            params = OrderedDict(parse_qsl(url.query, keep_blank_values=True))
+            if params and not self.command(params):
+                return (400, b'<html><body><h1>Bad Request</h1></body></html>')
+
+            return (200, self.renderState())
+
+        # version information
+        if path == self.model.versionPath:
+            return (200, self.renderVersion())
+
+        if path in VERSION_PATHS:
+            # WebRelay6 and WebRelay10 answer with a 404 Error page and a 200 code
+            if self.model.versionPath == '/home.html':
+                return (200, b'<html><body><h1>404 Error</h1><p>File not found</p></body></html>')
+
+            return (404, b'<html><body><h1>Not Found</h1></body></html>')
+
+        # updates
+        params = OrderedDict(parse_qsl(url.query, keep_blank_values=True))
+        if path.endswith('.srv') and self.update(path, params):
+            return (200, b'<html><body><p>Settings saved</p></body></html>')
+
+        return (404, b'<html><body><h1>Not Found</h1></body></html>')
+
+def guess_content_type(target):
+    '''Return the Content-Type of the response to a request for the target (path and query)'''
+    if urlsplit(target).path.endswith('.xml'):
+        return 'text/xml'
+
+    return 'text/html'
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    '''HTTP request handler for a simulated device, with keep-alive'''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug('Simulator %s: ' + format, self.server.hostname, *args)
+
+    def setup(self):
+        # drop idle keep-alive connections, freeing their slot
+        self.timeout = self.server.idleTimeout
+        super().setup()
+
+        # the headers and the content are written separately: without this,
+        # each response on a keep-alive connection waits for a delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        # like the real device, refuse connections over the limit
+        if not self.server.openConnection():
+            return
+
+        try:
+            super().handle()
+        finally:
+            self.server.closeConnection()
+
+    def do_GET(self):
+        server = self.server
+        server.delay()
+        server.count('requests')
+
+        device = server.device
+        if not device.checkAuthorization(self.headers.get('Authorization')):
+            server.count('unauthorized')
+            self.sendResponse(401, b'<html><body><h1>401 Unauthorized</h1></body></html>',
+                              {'WWW-Authenticate': 'Basic realm="WebRelay"', })
+            return
+
+        status, content = device.handle(self.path)
+        self.sendResponse(status, content, contentType=guess_content_type(self.path))
+
+    def sendResponse(self, status, content, headers=None, contentType='text/html'):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+
+        self.end_headers()
+        self.wfile.write(content)
+
+class SimulatorServer(ThreadingMixIn, HTTPServer):
+    '''Threaded HTTP server for one simulated device'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, device, address=('127.0.0.1', 0), latency=0.0, jitter=0.0, max_connections=None,
+                 idle_timeout=5):
+        super().__init__(address, SimulatorHandler)
+        self.device = device
+        self.latency = latency
+        self.jitter = jitter
+        self.maxConnections = max_connections
+        self.idleTimeout = idle_timeout
+        self.hostname = '{}:{}'.format(*self.server_address[:2])
+
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.stats = Counter()
+        self.random = random.Random()
+
+    def openConnection(self):
+        '''Count a new connection, returning False if it is over the limit'''
+        with self.lock:
+            if self.maxConnections is not None and self.connections >= self.maxConnections:
+                self.stats['refused'] += 1
+                return False
+
+            self.connections += 1
+            self.stats['connections'] += 1
+            return True
+
+    def closeConnection(self):
+        with self.lock:
+            self.connections -= 1
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def delay(self):
+        '''Wait for the configured latency, plus a random jitter'''
+        with self.lock:
+            seconds = self.latency + self.random.uniform(0, self.jitter)
+
+        if seconds > 0:
+            time.sleep(seconds)
+
+class WebRelay_Simulator(object):
+    '''
+    One simulated WebRelay device, served on its own port in a background
+    thread. Use the hostname attribute ("host:port") to connect to it.
+    '''
+    def __init__(self, model, serialNumber, username='admin', password='webrelay', host='127.0.0.1', port=0,
+                 latency=0.0, jitter=0.0, max_connections=None, idle_timeout=5):
+        self.device = Simulated_WebRelay(model, serialNumber, username, password)
+        self.server = SimulatorServer(self.device, (host, port), latency, jitter, max_connections, idle_timeout)
+        self.hostname = self.server.hostname
+        self.thread = None
+
+    def start(self):
+        '''Start serving requests in a background thread'''
+        self.thread = threading.Thread(target=self.server.serve_forever, name=self.hostname)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''Stop serving requests and close the listening socket'''
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def getStats(self):
+        '''Return a copy of the request statistics'''
+        with self.server.lock:
+            stats = Counter(self.server.stats)
+
+        with self.device.lock:
+            stats['writes'] = self.device.writes
+            stats['commands'] = self.device.commands
+
+        return stats
+
+def simulated_serial_number(index):
+    '''Generate a MAC address style serial number for the Nth simulated device'''
+    return '00:0C:C8:{:02X}:{:02X}:{:02X}'.format((index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)
+
+def start_simulators(models, count, port=0, **kwargs):
+    '''
+    Start count simulated devices, cycling through the list of models. With
+    a non-zero port, the devices use consecutive ports starting there.
+    '''
+    simulators = []
+    try:
+        for index in range(count):
+            model = models[index % len(models)]
+            devicePort = port + index if port else 0
+            simulator = WebRelay_Simulator(model, simulated_serial_number(index + 1), port=devicePort, **kwargs)
+            simulator.start()
+            simulators.append(simulator)
+    except Exception:
+        stop_simulators(simulators)
+        raise
+
+    return simulators
+
+def stop_simulators(simulators):
+    '''Stop all of the simulated devices'''
+    for simulator in simulators:
+        simulator.stop()
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
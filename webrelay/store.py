@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+'''
+Incremental store of WebRelay configuration snapshots.
+
+Each snapshot of a device is split into its configuration pages (the keys
+of WebRelay_Base.toDict(), which are the WebRelay_Page names), and each page
+is identified by a hash of its normalized settings. Only the pages whose
+hash changed since the previous snapshot of the device are stored (a
+delta). Every so often the complete configuration is stored instead (a full
+snapshot), so that rebuilding any version only reads a short chain of files.
+
+Every snapshot is recorded as one line in an append-only index, holding the
+hashes of the changed pages. Questions like "what changed on which device
+since date X" are answered from the index alone, without reading any of the
+stored configurations.
+
+Layout of the store directory:
+- index.jsonl: one JSON line per recorded snapshot
+- devices/<device>/<sequence>.json: full or delta snapshots of one device
+'''
+
+from __future__ import print_function
+
+from collections import OrderedDict
+from collections import namedtuple
+
+import threading
+import datetime
+import hashlib
+import json
+import time
+import os
+
+# Accepted formats of dates and times (local time)
+TIMESTAMP_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S')
+
+# Kinds of index entries: complete configuration, changed pages only, or nothing changed
+KIND_FULL = 'full'
+KIND_DELTA = 'delta'
+KIND_NONE = 'none'
+
+# Structure to hold one entry of the index
+IndexEntry = namedtuple('IndexEntry', [
+    'timestamp',
+    'hostname',
+    'modelNumber',
+    'serialNumber',
+    'sequence',
+    'kind',
+    'changed',
+])
+
+# Structure to hold the latest state of one device in the store, and its number of index entries
+DeviceHead = namedtuple('DeviceHead', [
+    'hostname',
+    'modelNumber',
+    'serialNumber',
+    'sequence',
+    'chainLength',
+    'hashes',
+    'snapshots',
+])
+
+def parse_timestamp(text):
+    '''Parse a local date and time in one of the TIMESTAMP_FORMATS into a UNIX timestamp'''
+    for format in TIMESTAMP_FORMATS:
+        try:
+            return time.mktime(datetime.datetime.strptime(text, format).timetuple())
+        except ValueError:
+            pass
+
+    raise ValueError('Date and time format not recognized: {}'.format(text))
+
+def format_timestamp(timestamp):
+    '''Format a UNIX timestamp as a local date and time'''
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S')
+
+def hash_page(settings):
+    '''Hash the normalized settings of one configuration page'''
+    data = json.dumps(settings, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def device_key(serialNumber, hostname):
+    '''Return the key of a device in the store: its serial number, or its hostname if that is unknown'''
+    key = serialNumber or hostname
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in key)
+
+class SnapshotStore(object):
+    '''
+    Incremental, content hashed store of device configuration snapshots.
+
+    A snapshot may hold only some of the pages of a device (for example,
+    from a partial fetch): missing pages are treated as unchanged, never as
+    deleted. A full snapshot is written for the first snapshot of a device,
+    and whenever full_interval deltas have been written since the last one.
+    '''
+    def __init__(self, directory, full_interval=10):
+        self.directory = directory
+        self.fullInterval = full_interval
+        self.indexFilename = os.path.join(directory, 'index.jsonl')
+        self.lock = threading.Lock()
+
+        # device key -> DeviceHead
+        self.heads = OrderedDict()
+        # device key -> list of (timestamp, sequence, kind) of the stored files
+        self.files = {}
+
+        os.makedirs(os.path.join(directory, 'devices'), exist_ok=True)
+        for entry in self.readIndex():
+            self.applyEntry(entry)
+
+    def readIndex(self):
+        '''Generate every entry of the index, oldest first'''
+        try:
+            f = open(self.indexFilename, 'r')
+        except FileNotFoundError:
+            return
+
+        with f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+
+                data = json.loads(line, object_pairs_hook=OrderedDict)
+                yield IndexEntry(**data)
+
+    def applyEntry(self, entry):
+        '''Update the in-memory state of a device with an index entry'''
+        key = device_key(entry.serialNumber, entry.hostname)
+        head = self.heads.get(key)
+
+        hashes = OrderedDict(head.hashes) if head is not None else OrderedDict()
+        hashes.update(entry.changed)
+
+        if entry.kind == KIND_FULL:
+            chainLength = 0
+        elif entry.kind == KIND_DELTA:
+            chainLength = head.chainLength + 1
+        else:
+            chainLength = head.chainLength
+
+        snapshots = head.snapshots + 1 if head is not None else 1
+        self.heads[key] = DeviceHead(entry.hostname, entry.modelNumber, entry.serialNumber, entry.sequence,
+                                     chainLength, hashes, snapshots)
+
+        if entry.kind != KIND_NONE:
+            self.files.setdefault(key, []).append((entry.timestamp, entry.sequence, entry.kind))
+
+    def getFilename(self, key, sequence):
+        return os.path.join(self.directory, 'devices', key, '{:08d}.json'.format(sequence))
+
+    def writeFile(self, key, sequence, pages):
+        '''Write the pages of one snapshot atomically'''
+        filename = self.getFilename(key, sequence)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        tmpname = '{}.tmp'.format(filename)
+        with open(tmpname, 'w') as f:
+            json.dump(pages, f, separators=(',', ':'))
+
+        os.replace(tmpname, filename)
+
+    def readFile(self, key, sequence):
+        with open(self.getFilename(key, sequence), 'r') as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+
+    def record(self, hostname, modelNumber, serialNumber, configuration, timestamp=None):
+        '''
+        Record a snapshot of the configuration of one device, storing only
+        the pages which changed. Return the IndexEntry.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+
+        key = device_key(serialNumber, hostname)
+
+        with self.lock:
+            head = self.heads.get(key)
+            oldHashes = head.hashes if head is not None else {}
+
+            changed = OrderedDict()
+            for name, settings in configuration.items():
+                digest = hash_page(settings)
+                if oldHashes.get(name) != digest:
+                    changed[name] = digest
+
+            if head is None or (changed and head.chainLength >= self.fullInterval):
+                # the complete configuration: the previous version, with this snapshot on top
+                pages = self.loadLocked(key) if head is not None else OrderedDict()
+                pages.update(configuration)
+                kind = KIND_FULL
+            elif changed:
+                pages = OrderedDict((name, configuration[name]) for name in changed)
+                kind = KIND_DELTA
+            else:
+                pages = None
+                kind = KIND_NONE
+
+            sequence = head.sequence if head is not None else 0
+            if pages is not None:
+                sequence += 1
+                self.writeFile(key, sequence, pages)
+
+            entry = IndexEntry(timestamp, hostname, modelNumber, serialNumber, sequence, kind, changed)
+            with open(self.indexFilename, 'a') as f:
+                f.write(json.dumps(entry._asdict(), separators=(',', ':')))
+                f.write('\n')
+
+            self.applyEntry(entry)
+            return entry
+
+    def load(self, key, timestamp=None):
+        '''
+        Rebuild the configuration of a device (by device key), as of the
+        given time, or the latest one. Return None if there is no snapshot
+        that old.
+        '''
+        with self.lock:
+            return self.loadLocked(key, timestamp)
+
+    def loadLocked(self, key, timestamp=None):
+        files = self.files.get(key, [])
+        if timestamp is not None:
+            files = [item for item in files if item[0] <= timestamp]
+
+        # replay from the last full snapshot (snapshots recorded out of order may leave none)
+        fulls = [index for index, item in enumerate(files) if item[2] == KIND_FULL]
+        if not fulls:
+            return None
+
+        start = fulls[-1]
+
+        pages = OrderedDict()
+        for timestamp, sequence, kind in files[start:]:
+            pages.update(self.readFile(key, sequence))
+
+        return pages
+
+    def devices(self):
+        '''Return the (device key, DeviceHead) of every device in the store'''
+        with self.lock:
+            return list(self.heads.items())
+
+    def findDevice(self, name):
+        '''Find the key of a device by its key, serial number or hostname. Return None if it is unknown.'''
+        for key, head in self.devices():
+            if name in (key, head.serialNumber, head.hostname):
+                return key
+
+        return None
+
+    def changesSince(self, timestamp, key=None):
+        '''
+        Generate the index entries which changed any page at or after the
+        given time, optionally for a single device only. Only the index is
+        read, never the stored configurations.
+        '''
+        for entry in self.readIndex():
+            if entry.timestamp < timestamp or not entry.changed:
+                continue
+
+            if key is not None and device_key(entry.serialNumber, entry.hostname) != key:
+                continue
+
+            yield entry
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -7,11 +7,19 @@ from webrelay.device import WebRelay4
 from webrelay.device import WebRelay6
 from webrelay.device import WebRelay10
 
+from webrelay.device.base import MAX_PAGE_CONCURRENCY
+from webrelay.device.parser import get_parser
+
+from webrelay.session import WebRelay_Session
+from webrelay.session import masked
+
+from webrelay.metrics import timed
+
+from concurrent.futures import ThreadPoolExecutor
 from collections import namedtuple
 
 import requests
 import logging
-import bs4
 import sys
 import re
 
@@ -22,6 +30,12 @@ VersionInfo = namedtuple('VersionInfo', [
     'serialNumber',
 ])
 
+# Page used to test credentials, available on all models
+CREDENTIALS_PATH = '/networkSetup.html'
+
+# Pages which may contain the version information, in the order to try them
+VERSION_PATHS = ('/about.html', '/home.html')
+
 # Structure to hold WebRelay credentials
 Credentials = namedtuple('Credentials', [
     'hostname',
@@ -53,138 +67,194 @@ def generate_authentication(username=None, password=None, password_file=None):
     # Return the list of possible credentials
     return credentials
 
-def test_credentials(creds):
+def check_credentials_response(response):
     '''
-    Test if the given credentials is valid for configuring a WebRelay device.
+    Check the response to the credentials test request: return True if the
+    credentials are valid, and False if they were rejected.
     '''
-    logging.debug('Testing Credentials: USER={} PASS={}'.format(creds.username, creds.password))
+    # most models of device return 401 Unauthorized errors
+    if response.status_code == 401:
+        return False
 
-    try:
-        url = 'http://{}/networkSetup.html'.format(creds.hostname)
-        auth = requests.auth.HTTPBasicAuth(creds.username, creds.password)
-        response = requests.get(url, auth=auth, timeout=10)
+    response.raise_for_status()
+    return True
 
-        # most models of device return 401 Unauthorized errors
-        if response.status_code == 401:
-            return False
+def test_credentials(creds, session=None):
+    '''
+    Test if the given credentials is valid for configuring a WebRelay device.
+    '''
+    logging.debug('Testing Credentials: USER=%s PASS=%s', creds.username, masked(creds.password))
 
-        response.raise_for_status()
-        return True
+    if session is None:
+        session = WebRelay_Session()
+
+    try:
+        response = session.get(creds.hostname, CREDENTIALS_PATH, creds.username, creds.password, remember=True)
+        return check_credentials_response(response)
     except requests.exceptions.ConnectionError as ex:
         raise
     except Exception as ex:
-        print('Unexpected Exception: {}'.format(str(ex)))
+        print('Unexpected Exception: {}'.format(str(ex)), file=sys.stderr)
         return False
 
-def detect_credentials(hostname, username=None, password=None, password_file=None):
+@timed('detect_credentials')
+def find_credentials(hostname, username=None, password=None, password_file=None, session=None, concurrency=1):
     '''
     Generate a credentials list, and try them until a working set is found.
+
+    With a concurrency greater than one, up to that many credentials (but
+    never more than MAX_PAGE_CONCURRENCY) are tested at the same time. The
+    results are still checked in order, so the first working credentials in
+    the list always win, and any tests which have not yet started are
+    cancelled as soon as the winner is known.
+
+    Network errors are raised to the caller as requests exceptions.
     '''
     # generate list of credentials to try
     credentials = generate_authentication(username, password, password_file)
+    candidates = [Credentials(hostname, username, password) for username, password in credentials]
+
+    # share one connection pool between all attempts
+    if session is None:
+        session = WebRelay_Session()
+
+    concurrency = max(1, min(concurrency, MAX_PAGE_CONCURRENCY))
 
     # test each set of credentials to see if we can authenticate successfully
-    for username, password in credentials:
-        try:
-            creds = Credentials(hostname, username, password)
-            success = test_credentials(creds)
+    if concurrency == 1:
+        for creds in candidates:
+            success = test_credentials(creds, session)
             if success:
-                logging.debug('Detected working credentials: USER={} PASS={}'.format(username, password))
+                logging.debug('Detected working credentials: USER=%s PASS=%s', creds.username,
+                              masked(creds.password))
                 return creds
-        except requests.exceptions.RequestException as ex:
-            # die with an error message on any sort of network errors
-            print('ERROR:', str(ex), file=sys.stderr)
-            sys.exit(1)
 
-    return None
+        return None
 
-def search_text(soup, pattern):
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    futures = [executor.submit(test_credentials, creds, session) for creds in candidates]
+    try:
+        for creds, future in zip(candidates, futures):
+            success = future.result()
+            if success:
+                logging.debug('Detected working credentials: USER=%s PASS=%s', creds.username,
+                              masked(creds.password))
+                return creds
+
+        return None
+    finally:
+        for future in futures:
+            future.cancel()
+
+        executor.shutdown(wait=False)
+
+def detect_credentials(hostname, username=None, password=None, password_file=None, session=None, concurrency=1):
+    '''
+    Generate a credentials list, and try them until a working set is found.
     '''
-    Helper method to search the about.html/home.html page for version
-    information.
+    try:
+        return find_credentials(hostname, username, password, password_file, session, concurrency)
+    except requests.exceptions.RequestException as ex:
+        # die with an error message on any sort of network errors
+        print('ERROR:', str(ex), file=sys.stderr)
+        sys.exit(1)
+
+def search_text(texts, pattern):
+    '''
+    Helper method to search the text of the about.html/home.html page for
+    version information.
     '''
     # WebRelay1 and WebRelay4 have their information within <p> elements
     # within a single table row. Try to find the information here first.
-    for element in soup.find_all(name='p'):
-        match = pattern.search(element.text)
+    for text in texts['p']:
+        match = pattern.search(text)
         if match:
             return match
 
     # WebRelay6 and WebRelay10 have their information within <tr> elements,
     # one for each datum. Look here second.
-    for element in soup.find_all(name='tr'):
-        match = pattern.search(element.text)
+    for text in texts['tr']:
+        match = pattern.search(text)
         if match:
             return match
 
     # No match
     return None
 
-def fetch_version_information(creds):
+def parse_version_information(status_code, content):
+    '''
+    Parse the version information from the about.html/home.html page into a
+    VersionInfo structure. Return None if this page does not exist on this
+    device model.
+    '''
+    # this page was not found
+    if status_code == 404:
+        return None
+
+    # unfortunately, some variants of this device are mentally challenged,
+    # and return a 200 response code with a 404 error in the content
+    pattern = re.compile('404 Error')
+    if pattern.search(content.decode('utf-8')):
+        return None
+
+    # turn the whole page into plain text
+    texts = get_parser().parseText(content, ('p', 'tr'))
+
+    # Model Number
+    # WebRelay1 and WebRelay4 call this "Model"
+    # WebRelay6 and WebRelay10 call this "Part Number"
+    pattern = re.compile(r'(Model|Part Number):\s*(\S+)', re.IGNORECASE)
+    match = search_text(texts, pattern)
+    if not match:
+        raise RuntimeError('Model Number not found')
+
+    modelNumber = match.group(2)
+
+    # Firmware Version
+    # WebRelay1 and WebRelay4 call this "Product Revision"
+    # WebRelay6 and WebRelay10 call this "Firmware Revision"
+    pattern = re.compile(r'(Product|Firmware) Revision:\s*(\S+)', re.IGNORECASE)
+    match = search_text(texts, pattern)
+    if not match:
+        raise RuntimeError('Firmware Version not found')
+
+    firmwareVersion = match.group(2)
+
+    # Serial Number
+    # All variants call this "Serial Number"
+    pattern = re.compile(r'Serial Number:\s*(\S+)', re.IGNORECASE)
+    match = search_text(texts, pattern)
+    if not match:
+        raise RuntimeError('Serial Number not found')
+
+    serialNumber = match.group(1)
+
+    # return the structure
+    return VersionInfo(modelNumber, firmwareVersion, serialNumber)
+
+@timed('fetch_version_information')
+def fetch_version_information(creds, session=None):
     '''
     Fetch the WebRelay version information into a VersionInfo structure.
     '''
-    for path in ('about.html', 'home.html'):
-        url = 'http://{}/{}'.format(creds.hostname, path)
-        auth = requests.auth.HTTPBasicAuth(creds.username, creds.password)
-        response = requests.get(url, auth=auth, timeout=10)
-
-        # decode the content into a Python string
-        content = response.content.decode('utf-8')
-
-        # this page was not found
-        if response.status_code == 404:
-            continue
-
-        # unfortunately, some variants of this device are mentally challenged,
-        # and return a 200 response code with a 404 error in the content
-        pattern = re.compile('404 Error')
-        if pattern.search(content):
-            continue
-
-        # turn the whole page into plain text
-        soup = bs4.BeautifulSoup(response.content, 'html.parser')
-
-        # Model Number
-        # WebRelay1 and WebRelay4 call this "Model"
-        # WebRelay6 and WebRelay10 call this "Part Number"
-        pattern = re.compile(r'(Model|Part Number):\s*(\S+)', re.IGNORECASE)
-        match = search_text(soup, pattern)
-        if not match:
-            raise RuntimeError('Model Number not found')
-
-        modelNumber = match.group(2)
-
-        # Firmware Version
-        # WebRelay1 and WebRelay4 call this "Product Revision"
-        # WebRelay6 and WebRelay10 call this "Firmware Revision"
-        pattern = re.compile(r'(Product|Firmware) Revision:\s*(\S+)', re.IGNORECASE)
-        match = search_text(soup, pattern)
-        if not match:
-            raise RuntimeError('Firmware Version not found')
-
-        firmwareVersion = match.group(2)
-
-        # Serial Number
-        # All variants call this "Serial Number"
-        pattern = re.compile(r'Serial Number:\s*(\S+)', re.IGNORECASE)
-        match = search_text(soup, pattern)
-        if not match:
-            raise RuntimeError('Serial Number not found')
+    if session is None:
+        session = WebRelay_Session()
 
-        serialNumber = match.group(1)
+    for path in VERSION_PATHS:
+        response = session.get(creds.hostname, path, creds.username, creds.password)
 
-        # return the structure
-        return VersionInfo(modelNumber, firmwareVersion, serialNumber)
+        info = parse_version_information(response.status_code, response.content)
+        if info is not None:
+            return info
 
     # None of the possible information pages was accessible
     raise RuntimeError('Unable to fetch version information')
 
-def get_webrelay_device(creds):
+def create_webrelay_device(creds, info, session=None):
     '''
-    Get the specialized device class for this WebRelay.
+    Create the specialized device class for a WebRelay with the given
+    version information.
     '''
-    info = fetch_version_information(creds)
     model = info.modelNumber
 
     # TODO FIXME: simplify
@@ -193,16 +263,156 @@ def get_webrelay_device(creds):
     password = creds.password
 
     if model.startswith('X-WR-1R'):
-        return WebRelay1(hostname, username, password)
+        device = WebRelay1(hostname, username, password, session)
     elif model.startswith('X-WR-4R'):
-        return WebRelay4(hostname, username, password)
+        device = WebRelay4(hostname, username, password, session)
     elif model.startswith('X-WR-6R'):
-        return WebRelay6(hostname, username, password)
+        device = WebRelay6(hostname, username, password, session)
     elif model.startswith('X-WR-10R'):
-        return WebRelay10(hostname, username, password)
+        device = WebRelay10(hostname, username, password, session)
     else:
         raise RuntimeError('Unsupported model {}'.format(model))
 
+    device.versionInfo = info
+    return device
+
+def get_webrelay_device(creds, session=None):
+    '''
+    Get the specialized device class for this WebRelay.
+
+    The device uses the same HTTP session (connection pool) as was used to
+    detect the version information.
+    '''
+    if session is None:
+        session = WebRelay_Session()
+
+    info = fetch_version_information(creds, session)
+    return create_webrelay_device(creds, info, session)
+
+def get_cached_webrelay_device(hostname, credentials, session, cache):
+    '''
+    Create the specialized device class for this WebRelay from the device
+    cache, without any network requests. Return None on a cache miss.
+    '''
+    cached = cache.lookup(hostname, credentials)
+    if cached is None:
+        return None
+
+    creds, info = cached
+    logging.debug('Using cached credentials and model %s for %s', info.modelNumber, hostname)
+    return create_webrelay_device(creds, info, session)
+
+def connect_webrelay_device(hostname, username=None, password=None, password_file=None, session=None,
+                            concurrency=1, cache=None, check=False):
+    '''
+    Detect the credentials and model of a WebRelay, and return the
+    specialized device class for it. Return None if no working credentials
+    were found.
+
+    With a DeviceCache, a fresh cache entry skips detection altogether, and
+    the result of a detection is recorded in the cache. With check, the
+    cached credentials are tested first (one request), and if the device
+    rejects them, the cache entry is invalidated and the device is detected
+    again.
+    '''
+    if session is None:
+        session = WebRelay_Session()
+
+    if cache is not None:
+        credentials = generate_authentication(username, password, password_file)
+        device = get_cached_webrelay_device(hostname, credentials, session, cache)
+        if device is not None:
+            if not check:
+                return device
+
+            response = session.get(hostname, CREDENTIALS_PATH, device.username, device.password)
+            if check_credentials_response(response):
+                return device
+
+            logging.debug('Cached credentials for %s were rejected, detecting again', hostname)
+            cache.invalidate(hostname)
+
+    creds = find_credentials(hostname, username, password, password_file, session, concurrency)
+    if creds is None:
+        return None
+
+    device = get_webrelay_device(creds, session)
+
+    if cache is not None:
+        cache.update(creds, device.versionInfo)
+
+    return device
+
+def load_webrelay_device(hostname, username=None, password=None, password_file=None, session=None,
+                         concurrency=1, cache=None, pages=None, parse_cache=None):
+    '''
+    Connect to a WebRelay (see connect_webrelay_device()) and load all of
+    its settings, or only the pages with the given names. Return None if no
+    working credentials were found.
+
+    With a ParseCache, pages which did not change since they were last
+    parsed are restored from the cache instead of being parsed again.
+
+    If the device was created from the cache, but it rejects the cached
+    credentials or its pages do not match the cached model, then the cache
+    entry is invalidated and the device is detected again.
+    '''
+    if session is None:
+        session = WebRelay_Session()
+
+    if cache is not None:
+        credentials = generate_authentication(username, password, password_file)
+        device = get_cached_webrelay_device(hostname, credentials, session, cache)
+        if device is not None:
+            try:
+                device.parseCache = parse_cache
+                device.loadFromDevice(concurrency, pages)
+                return device
+            except requests.exceptions.HTTPError as ex:
+                if ex.response is None or ex.response.status_code != 401:
+                    raise
+
+                logging.debug('Cached credentials for %s were rejected, detecting again', hostname)
+            except RuntimeError as ex:
+                logging.debug('Device %s does not match the cached model (%s), detecting again', hostname, ex)
+
+            cache.invalidate(hostname)
+
+    try:
+        device = connect_webrelay_device(hostname, username, password, password_file, session, concurrency, cache)
+    except Exception:
+        # nothing will be loaded: drop the responses remembered during detection
+        session.forget(hostname)
+        raise
+
+    if device is None:
+        return None
+
+    device.parseCache = parse_cache
+    device.loadFromDevice(concurrency, pages)
+    return device
+
+class QueryMaskingFilter(logging.Filter):
+    '''
+    Hide the query parameters of update requests (which may hold new
+    passwords) in the messages of other libraries, such as the request log
+    of urllib3. The parameters of each write are logged, masked, by the
+    device itself.
+    '''
+    def filter(self, record):
+        if record.args and isinstance(record.args, tuple):
+            record.args = tuple(mask_query(arg) for arg in record.args)
+
+        return True
+
+def mask_query(value):
+    '''Hide the query parameters of an update request URL (a .srv path)'''
+    if isinstance(value, str) and '.srv?' in value:
+        path, query = value.split('?', 1)
+        return '{}?<{} parameters>'.format(path, len(query.split('&')))
+
+    return value
+
 def setup_logging(level=logging.INFO, stream=sys.stdout):
     # get the default logger instance
     logger = logging.getLogger()
@@ -217,6 +427,9 @@ def setup_logging(level=logging.INFO, stream=sys.stdout):
     fmt = '%(asctime)s.%(msecs).03d %(levelname)7s: %(message)s'
     formatter = logging.Formatter(fmt, datefmt='%Y-%m-%d %H:%M:%S')
 
+    # never log new passwords
+    ch.addFilter(QueryMaskingFilter())
+
     # and hook it all together
     ch.setFormatter(formatter)
     logger.addHandler(ch)